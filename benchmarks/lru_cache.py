@@ -0,0 +1,90 @@
+"""
+Micro-benchmark of gutils.lru_cache per-call overhead on a cache hit.
+
+Compares the string concatenation key builder lru_cache used before make_key
+with the structural keys for typical call signatures.
+
+    python benchmarks/lru_cache.py --calls 200000
+"""
+import argparse
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings  # noqa: E402
+
+if not settings.configured:
+    settings.configure(USE_I18N=False)
+
+from django.utils.encoding import force_str  # noqa: E402
+import gutils.lru_cache  # noqa: E402
+from gutils.lru_cache import lru_cache  # noqa: E402
+
+
+def legacy_make_key(args, kwargs):
+    def as_text(obj):
+        result = getattr(obj, 'pk', None)
+        if result is not None:
+            return force_str(result)
+        return force_str(obj)
+
+    kwargs_key = "".join(map(lambda x: force_str(x) + force_str(type(kwargs[x])) + as_text(kwargs[x]), sorted(kwargs)))
+    return u"".join(map(lambda x: force_str(type(x)) + as_text(x), args)) + kwargs_key
+
+
+class Meta(object):
+    label = 'shop.Product'
+
+
+class Product(object):
+    """ Stands for a model instance: only _meta and pk are used by the key """
+    _meta = Meta()
+
+    def __init__(self, pk):
+        self.pk = pk
+
+
+@lru_cache(maxsize=1000)
+def cached(*args, **kwargs):
+    return len(args) + len(kwargs)
+
+
+CASES = [
+    ('int', (42,), {}),
+    ('str', ('price-list',), {}),
+    ('str, int', ('price-list', 42), {}),
+    ('model', (Product(42),), {}),
+    ('date, kwargs', (datetime.date(2020, 1, 1),), {'currency': 'UAH', 'rate': 1.5}),
+]
+
+
+def measure(calls, args, kwargs):
+    cached(*args, **kwargs)
+    started = time.perf_counter()
+    for i in range(calls):
+        cached(*args, **kwargs)
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--calls', type=int, default=200000)
+    args = parser.parse_args()
+
+    make_key = gutils.lru_cache.make_key
+    print('%-14s %12s %12s %8s' % ('arguments', 'before, us', 'after, us', 'speedup'))
+    for title, call_args, call_kwargs in CASES:
+        gutils.lru_cache.make_key = legacy_make_key
+        cached.cache_clear()
+        before = measure(args.calls, call_args, call_kwargs)
+        gutils.lru_cache.make_key = make_key
+        cached.cache_clear()
+        after = measure(args.calls, call_args, call_kwargs)
+        print('%-14s %12.3f %12.3f %7.1fx' % (title, before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
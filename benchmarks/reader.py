@@ -0,0 +1,210 @@
+"""
+Throughput benchmark of gutils.reader for every supported format.
+
+Generates deterministic synthetic files (CSV in utf8/cp1251/cp866 with each delimiter, xls, xlsx,
+dbf and html), then runs Reader(...).parse(struct=...), count and preview on each one in a separate
+process and prints the results as JSON: rows/s, time to the first row and peak RSS.
+
+    python benchmarks/reader.py --rows 10000 1000000 --formats csv xlsx --output result.json
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import resource
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings  # noqa: E402
+
+if not settings.configured:
+    settings.configure(USE_I18N=False)
+
+from gutils.reader import Reader  # noqa: E402
+
+COLUMNS = ['code', 'brand', 'name', 'price', 'qty', 'date']
+STRUCT = dict((name, index) for index, name in enumerate(COLUMNS, start=1))
+REQUIRED = ['code', 'price']
+BRANDS = ['Bosch', 'Febi', 'Лемфордер', 'Sachs', 'Мотор Січ', 'Valeo']
+WORDS = ['фільтр', 'oil', 'колодки', 'pump', 'ремінь', 'bearing', 'свічка', 'gasket']
+CSV_ENCODINGS = ['utf8', 'cp1251', 'cp866']
+CSV_DELIMITERS = {'semicolon': ';', 'tab': '\t', 'comma': ',', 'colon': ':'}
+FORMATS = ['csv', 'xls', 'xlsx', 'dbf', 'html']
+XLS_MAX_ROWS = 65536
+
+
+def generate_rows(rows, seed=0):
+    rnd = random.Random(seed)
+    start = datetime.date(2020, 1, 1)
+    for i in range(rows):
+        yield [
+            'A%08d' % i,
+            rnd.choice(BRANDS),
+            '%s %s %d' % (rnd.choice(WORDS), rnd.choice(WORDS), rnd.randint(1, 999)),
+            '%d.%02d' % (rnd.randint(0, 99999), rnd.randint(0, 99)),
+            str(rnd.randint(0, 500)),
+            (start + datetime.timedelta(days=i % 1000)).isoformat(),
+        ]
+
+
+def write_csv(filename, rows, encoding, delimiter):
+    with open(filename, 'w', encoding=encoding, errors='replace') as f:
+        for row in generate_rows(rows):
+            f.write(delimiter.join(row))
+            f.write('\n')
+
+
+def write_html(filename, rows):
+    with open(filename, 'w', encoding='utf8') as f:
+        f.write('<html><body><table>\n')
+        for row in generate_rows(rows):
+            f.write('<tr>%s</tr>\n' % ''.join('<td>%s</td>' % value for value in row))
+        f.write('</table></body></html>\n')
+
+
+def write_xlsx(filename, rows):
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    for row in generate_rows(rows):
+        ws.append([row[0], row[1], row[2], float(row[3]), int(row[4]), row[5]])
+    wb.save(filename)
+
+
+def write_xls(filename, rows):
+    from xlwt import Workbook
+    wb = Workbook()
+    ws = None
+    for i, row in enumerate(generate_rows(rows)):
+        if i % XLS_MAX_ROWS == 0:
+            ws = wb.add_sheet('%s' % (i // XLS_MAX_ROWS))
+        for c, value in enumerate([row[0], row[1], row[2], float(row[3]), int(row[4]), row[5]]):
+            ws.write(i % XLS_MAX_ROWS, c, value)
+    wb.save(filename)
+
+
+def write_dbf(filename, rows):
+    # fields: name, type, length, decimals
+    fields = [(b'CODE', b'C', 10, 0), (b'BRAND', b'C', 20, 0), (b'NAME', b'C', 40, 0),
+              (b'PRICE', b'N', 12, 2), (b'QTY', b'N', 6, 0), (b'DATE', b'D', 8, 0)]
+    record_size = 1 + sum(f[2] for f in fields)
+    header_size = 32 + 32 * len(fields) + 1
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('<BBBBIHH20x', 3, 120, 1, 1, rows, header_size, record_size))
+        for name, kind, length, decimals in fields:
+            f.write(struct.pack('<11sc4xBB14x', name, kind, length, decimals))
+        f.write(b'\r')
+        for row in generate_rows(rows):
+            record = [b' ']
+            record.append(row[0].encode('cp1251').ljust(10)[:10])
+            record.append(row[1].encode('cp1251').ljust(20)[:20])
+            record.append(row[2].encode('cp1251').ljust(40)[:40])
+            record.append(row[3].encode('ascii').rjust(12))
+            record.append(row[4].encode('ascii').rjust(6))
+            record.append(row[5].replace('-', '').encode('ascii'))
+            f.write(b''.join(record))
+        f.write(b'\x1a')
+
+
+def fixtures(formats):
+    """ Yields (name, extension, writer, kwargs) of every fixture """
+    for file_format in formats:
+        if file_format == 'csv':
+            for encoding in CSV_ENCODINGS:
+                for name, delimiter in CSV_DELIMITERS.items():
+                    yield 'csv-%s-%s' % (encoding, name), '.csv', write_csv, dict(encoding=encoding, delimiter=delimiter)
+        else:
+            writer = globals()['write_%s' % file_format]
+            yield file_format, '.%s' % file_format, writer, {}
+
+
+def fixture(directory, name, extension, writer, kwargs, rows):
+    filename = os.path.join(directory, '%s-%s%s' % (name, rows, extension))
+    if not os.path.exists(filename):
+        writer(filename + '.tmp', rows, **kwargs)
+        os.rename(filename + '.tmp', filename)
+    return filename
+
+
+def run_parse(filename):
+    started = time.time()
+    first = None
+    rows = 0
+    for item in Reader(filename).parse(struct=STRUCT, required=REQUIRED):
+        if first is None:
+            first = time.time() - started
+        rows += 1
+    return dict(rows=rows, first_row=first, seconds=time.time() - started)
+
+
+def run_count(filename):
+    started = time.time()
+    rows = Reader(filename).count
+    return dict(rows=rows, seconds=time.time() - started)
+
+
+def run_preview(filename):
+    started = time.time()
+    rows = len(Reader(filename).preview())
+    return dict(rows=rows, seconds=time.time() - started)
+
+
+def _measure(queue, func, filename):
+    try:
+        result = func(filename)
+        # kilobytes on Linux
+        result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    except Exception as e:
+        result = dict(error=repr(e))
+    queue.put(result)
+
+
+def measure(func, filename):
+    """ Run func in a fresh process, so peak RSS belongs to this measurement only """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure, args=(queue, func, filename))
+    process.start()
+    result = queue.get()
+    process.join()
+    if result.get('seconds') and 'error' not in result:
+        result['rows_per_second'] = round(result['rows'] / result['seconds'], 1) if result['seconds'] else None
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000],
+                        help='file sizes in rows, e.g. 10000 1000000 10000000')
+    parser.add_argument('--formats', nargs='+', default=FORMATS, choices=FORMATS)
+    parser.add_argument('--dir', help='fixtures directory, generated files are kept there between runs')
+    parser.add_argument('--output', help='write JSON to file instead of stdout')
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp(prefix='gutils-reader-bench-')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    results = []
+    for rows in args.rows:
+        for name, extension, writer, kwargs in fixtures(args.formats):
+            filename = fixture(directory, name, extension, writer, kwargs, rows)
+            result = dict(fixture=name, rows=rows, size=os.path.getsize(filename))
+            for operation, func in (('parse', run_parse), ('count', run_count), ('preview', run_preview)):
+                result[operation] = measure(func, filename)
+            results.append(result)
+            print('%s %s rows: %s rows/s' % (name, rows, result['parse'].get('rows_per_second')), file=sys.stderr)
+    data = json.dumps(dict(python=sys.version.split()[0], results=results), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data)
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main()
@@ -136,7 +136,9 @@ class AdminFileImportView(AdminFormView):
         self.check_file()
         if self.filename:
             from gutils.reader import Reader
-            context['preview'] = Reader(self.filename).preview()
+            reader = Reader(self.filename)
+            context['preview'] = reader.preview()
+            context['preview_count'] = reader.estimated_count
         return context
 
     def get_prefix1(self):
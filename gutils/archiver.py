@@ -1,10 +1,18 @@
-from django.conf import settings
 from gutils.systems import execute
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA, BadZipFile
 import tempfile
+import tarfile
+import gzip
 import os
 import shutil
 import glob
-import re
+
+COPY_BUFFER_SIZE = 1024 * 1024
+ZIP_EXTENSIONS = ('.zip', '.zip_')
+GZIP_EXTENSIONS = ('.gz', '.gzip')
+TAR_EXTENSIONS = ('.tar', '.tgz', '.tbz2', '.txz', '.tar.gz', '.tar.bz2', '.tar.xz')
+ARCHIVE_EXTENSIONS = ZIP_EXTENSIONS + GZIP_EXTENSIONS + TAR_EXTENSIONS + ('.7z', '.rar', '.rar_')
+ZIP_METHODS = (ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA)
 
 
 def check_result(value):
@@ -13,12 +21,114 @@ def check_result(value):
     return ('Everything is Ok' in value) or ('All OK' in value)
 
 
+def archive_type(filename):
+    """ 'zip', 'gz' or 'tar' for archives read natively, None for others """
+    name = filename.lower()
+    if name.endswith(TAR_EXTENSIONS):
+        return 'tar'
+    ext = os.path.splitext(name)[1]
+    if ext in ZIP_EXTENSIONS:
+        return 'zip'
+    if ext in GZIP_EXTENSIONS:
+        return 'gz'
+    return None
+
+
+class ArchiveMember(object):
+    """
+    File inside zip, gz or tar archive, open() returns binary file object of the member data,
+    so it is read without extracting to disk. Without name the first file of the archive is used.
+    size is the uncompressed size, None for gz (its trailer keeps the size modulo 4 GB only).
+    readable is False for zip members zipfile can not decompress (deflate64, encrypted without password).
+    """
+
+    def __init__(self, filename, name=None, password=''):
+        if not os.path.exists(filename):
+            raise Exception('File %s does not exists' % filename)
+        self.filename = filename
+        self.kind = archive_type(filename)
+        self.password = password.encode('utf8') if isinstance(password, str) else password
+        self.size = None
+        self.readable = True
+        if self.kind == 'zip':
+            with ZipFile(filename) as archive:
+                info = self._find([(i.filename, i) for i in archive.infolist() if not i.is_dir()], name)
+                self.member, self.size = info.filename, info.file_size
+                self.readable = info.compress_type in ZIP_METHODS and (not info.flag_bits & 0x1 or bool(password))
+        elif self.kind == 'tar':
+            with tarfile.open(filename) as archive:
+                info = self._find([(i.name, i) for i in archive.getmembers() if i.isfile()], name)
+                self.member, self.size = info.name, info.size
+        elif self.kind == 'gz':
+            self.member = os.path.basename(os.path.splitext(filename)[0])
+            if name is not None and name != self.member:
+                raise Exception('There is no file "%s" in %s' % (name, filename))
+        else:
+            raise Exception('Wrong archive format')
+        self.name = os.path.basename(self.member)
+
+    def _find(self, members, name):
+        # exact path, then file name in any folder regardless of the case
+        if name is None:
+            # like "7z e" + "*.*": the first file with extension
+            members = [m for m in members if os.path.splitext(m[0])[1]] or members
+        else:
+            members = ([m for m in members if m[0] == name] or
+                       [m for m in members if os.path.basename(m[0]).lower() == os.path.basename(name).lower()])
+        if not members:
+            raise Exception('There is no file "%s" in %s' % (name or '', self.filename))
+        return members[0][1]
+
+    def open(self):
+        if self.kind == 'zip':
+            # the member keeps the archive file open after the archive is closed
+            with ZipFile(self.filename) as archive:
+                return archive.open(self.member, pwd=self.password or None)
+        if self.kind == 'tar':
+            return tarfile.open(self.filename).extractfile(self.member)
+        return gzip.open(self.filename, 'rb')
+
+    def read(self):
+        with self.open() as f:
+            return f.read()
+
+
+def _unpack_native(filename, destination, force_name='', password=''):
+    member = ArchiveMember(filename, password=password)
+    name = member.name
+    if member.kind == 'gz':
+        name = '%s%s' % (os.path.splitext(name)[0], os.path.splitext(name)[1] or '.csv')
+    if force_name:
+        name = '%s%s' % (force_name, os.path.splitext(name)[1])
+    result = os.path.join(destination, name)
+    try:
+        with member.open() as source, open(result, 'wb') as output:
+            shutil.copyfileobj(source, output, COPY_BUFFER_SIZE)
+    except Exception:
+        if os.path.exists(result):
+            os.remove(result)
+        raise
+    return result
+
+
 def unpack_file(filename, destination, force_name='', **kwarg):
+    """
+    Extract the first file of archive into destination, returns its filename.
+    zip, gz and tar are extracted in process, 7z, rar and zip methods not supported by zipfile
+    (e.g. deflate64, AES encryption) with 7z/unrar.
+    """
     password = kwarg.get('password', '')
     result = None
     ext = os.path.splitext(filename)[1].lower()
     if not os.path.exists(filename):
         raise Exception('File %s does not exists' % filename)
+    kind = archive_type(filename)
+    if kind:
+        try:
+            return _unpack_native(filename, destination, force_name, password)
+        except (NotImplementedError, RuntimeError, BadZipFile):
+            if kind != 'zip':
+                raise Exception('Error unpack "%s"' % filename)
     tmp_dir = tempfile.mkdtemp()
     if password:
         password = '-p%s' % password
@@ -28,13 +138,6 @@ def unpack_file(filename, destination, force_name='', **kwarg):
         if password == '':
             password = '-p-'
         command = 'unrar e -y %s %s %s' % (password, filename, tmp_dir)
-    elif ext in ('.gz', '.gzip'):
-        _filename = re.sub(r'\.gz^', '', filename, flags=re.I)
-        _ext = os.path.splitext(_filename.replace('.gz', ''))[1].lower() or '.csv'
-        result = os.path.join(destination, '%s%s' % (force_name, _ext))
-        command = 'gunzip -c %s > %s' % (filename, result)
-        execute(command)
-        return result
     else:
         raise Exception('Wrong archive format')
     if not check_result(execute(command)):
@@ -59,6 +162,7 @@ def pack_file(filename):
     destination = u"%s.zip" % filename
     if os.path.exists(destination):
         os.remove(destination)
-    if not check_result(execute(settings.GUTILS_ARCHIVER_NAME, 'a', '-tzip', '-y', '-mx1', destination, filename)):
-        raise Exception('Error creating "%s"' % destination)
+    # fast compression, like "7z -mx1"
+    with ZipFile(destination, 'w', ZIP_DEFLATED, compresslevel=1) as archive:
+        archive.write(filename, os.path.basename(filename))
     return destination
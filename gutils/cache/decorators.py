@@ -1,33 +1,64 @@
 from django.conf import settings
 from django.core.cache import cache
 from django.utils.functional import wraps
-from gutils.cache.utils import _cache_key, _func_type, _func_info
+from gutils.cache.utils import _cache_key, _func_type, _func_info, LocalCache
 
 
-def cached(timeout=None, force_key=None):
+def cached(timeout=None, force_key=None, local_timeout=None, local_size=1000):
+    """
+    Django cache decorator, the key is made of the function name and arguments.
+
+    local_timeout - seconds to keep values in process memory as well (LRU of local_size values),
+    hot values are returned without the Django cache round trip. The local values are pickled too, so every call
+    gets its own copy, as from the Django cache. Other processes do not see invalidate()
+    of the local values, so local_timeout should be short: it is how long they may return the old value.
+
+        @cached(3600, local_timeout=5)
+        def get_rates(currency):
+            ...
+
+        get_rates.invalidate('UAH')
+    """
     if not timeout:
         timeout = getattr(settings, 'DEFAULT_CACHE_TIME', 60)
 
     def _cached(func):
 
         func_type = _func_type(func)
+        local = LocalCache(local_timeout, local_size) if local_timeout else None
 
-        @wraps(func)
-        def wrapper(*args, **kwargs):
+        def make_key(args, kwargs, key_type):
+            # the same key for both tiers and for invalidate()
             if not hasattr(wrapper, '_full_name'):
+                if func_type != 'function' and key_type == 'function':
+                    # method name includes the class name, known after the first call only
+                    return None
                 name, _args = _func_info(func, args)
                 wrapper._full_name = name
-            key = _cache_key(wrapper._full_name, func_type, args, kwargs, force_key)
+            return _cache_key(wrapper._full_name, key_type, args, kwargs, force_key)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs, func_type)
+            if local is not None:
+                value = local.get(key)
+                if value is not None:
+                    return value
             value = cache.get(key)
             if value is None:
                 value = func(*args, **kwargs)
                 cache.set(key, value, timeout)
+            if local is not None:
+                local.set(key, value)
             return value
 
         def invalidate(*args, **kwargs):
-            if not hasattr(wrapper, '_full_name'):
+            # arguments without self / cls for methods
+            key = make_key(args, kwargs, 'function')
+            if key is None:
                 return
-            key = _cache_key(wrapper._full_name, 'function', args, kwargs)
+            if local is not None:
+                local.delete(key)
             cache.delete(key)
 
         wrapper.invalidate = invalidate
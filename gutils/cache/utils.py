@@ -1,11 +1,17 @@
 from django.utils.encoding import force_str, smart_bytes, force_bytes
 from unidecode import unidecode
+from threading import Lock
+import collections
 import hashlib
+import pickle
+import time
 import sys
 
 CONTROL_CHARACTERS = set([chr(i) for i in range(0, 33)])
 CONTROL_CHARACTERS.add(chr(127))
 MAX_LENGTH = 230
+# values stored by LocalCache as they are, others are pickled
+IMMUTABLE_TYPES = frozenset([str, int, float, bool])
 
 
 def _func_info(func, args):
@@ -87,3 +93,50 @@ def _cache_key(func_name, func_type, args, kwargs, force_key=None):
             h = ''
         key = "%s-%s" % (key[:MAX_LENGTH - 33], h)
     return key
+
+
+class LocalCache(object):
+    """
+    In-process LRU cache with expiration, the first tier in front of the Django cache.
+    get() returns None for missing and expired keys, like cache.get().
+    Values are pickled like in the Django cache, so every get() returns a new copy
+    and a caller changing it does not change the cached value.
+    """
+
+    def __init__(self, timeout, max_size=1000):
+        self.timeout = timeout
+        self.max_size = max_size
+        self.lock = Lock()
+        # {key: (value, expire time)}, the most recently used are at the end
+        self.data = collections.OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return None
+            if item[1] <= time.time():
+                del self.data[key]
+                return None
+            self.data.move_to_end(key)
+            value = item[0]
+        if value.__class__ in IMMUTABLE_TYPES:
+            return value
+        return pickle.loads(value)
+
+    def set(self, key, value):
+        if value.__class__ not in IMMUTABLE_TYPES:
+            value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.data[key] = (value, time.time() + self.timeout)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
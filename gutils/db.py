@@ -20,3 +20,16 @@ def server_side_cursor(using='default'):
         return db.cursor()
     else:
         return connection.cursor()
+
+
+def close_connections_before_fork():
+    """
+    Close database connections before worker processes are forked, so the workers do not share them
+    with the parent (the parent opens new connections when needed).
+    Inside transaction.atomic() closing would roll the transaction back, so it raises an exception.
+    """
+    for connection in connections.all():
+        if connection.in_atomic_block:
+            raise Exception('Worker processes can not be started inside transaction.atomic() (database "%s")'
+                            % connection.alias)
+    connections.close_all()
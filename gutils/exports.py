@@ -1,16 +1,612 @@
 # -*- coding: utf-8 -*-
-from django.utils.encoding import smart_bytes
+from django.utils.encoding import smart_bytes, force_str
 from django.template.loader import render_to_string
-from pyexcelerate import Workbook
-from xlwt import Workbook as WorkbookOld
+from django.http import StreamingHttpResponse
+from django.apps import apps
+from concurrent.futures import ProcessPoolExecutor
+from xlwt import Workbook as WorkbookOld, easyxf
+from openpyxl import load_workbook
+from xml.sax.saxutils import escape
+from zipfile import ZipFile, ZIP_DEFLATED
+from decimal import Decimal
+from gutils import get_attribute, content_disposition
+from gutils.db import close_connections_before_fork
 from gutils.decimals import to_decimal
-import tempfile
+from gutils.querysets import queryset_pk_ranges
 import datetime
+import tempfile
+import numbers
+import math
+import json
+import shutil
+import os
+import csv
 import re
 import io
 
+R_XML_ILLEGAL = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+EXCEL_EPOCH = datetime.datetime(1899, 12, 30)
+XLS_MAX_ROWS = 65536
+XLSX_MAX_ROWS = 1048576
+QUERYSET_CHUNK_SIZE = 2000
+COPY_BUFFER_SIZE = 1024 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'xls': 'application/vnd.ms-excel',
+}
+
+XLSX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '%s</Types>')
+XLSX_CONTENT_TYPE_SHEET = (
+    '<Override PartName="/xl/worksheets/sheet%s.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>')
+XLSX_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    '</Relationships>')
+XLSX_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets>%s</sheets></workbook>')
+XLSX_WORKBOOK_SHEET = '<sheet name="%s" sheetId="%s" r:id="rId%s"/>'
+XLSX_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId0" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+    'Target="styles.xml"/>'
+    '%s</Relationships>')
+XLSX_WORKBOOK_REL_SHEET = (
+    '<Relationship Id="rId%s" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet%s.xml"/>')
+# cell styles: 0 - general, 1 - date, 2 - date and time
+XLSX_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<numFmts count="2"><numFmt numFmtId="164" formatCode="yyyy\\-mm\\-dd"/>'
+    '<numFmt numFmtId="165" formatCode="yyyy\\-mm\\-dd\\ hh:mm:ss"/></numFmts>'
+    '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="3"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="165" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>')
+XLSX_SHEET_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+XLSX_SHEET_TAIL = '</sheetData></worksheet>'
+
+
+def _excel_date(value):
+    if isinstance(value, datetime.datetime):
+        delta = value.replace(tzinfo=None) - EXCEL_EPOCH
+        return delta.days + delta.seconds / 86400.0 + delta.microseconds / 86400000000.0
+    return (value - EXCEL_EPOCH.date()).days
+
+
+def xlsx_cell(value):
+    """ Cell XML of the value, rows are written without cell and row references """
+    if value is None or value == '':
+        return '<c/>'
+    cls = value.__class__
+    if cls is bool:
+        return '<c t="b"><v>%d</v></c>' % value
+    if cls is int:
+        return '<c><v>%s</v></c>' % value
+    if cls is datetime.datetime:
+        return '<c s="2"><v>%s</v></c>' % _excel_date(value)
+    if cls is datetime.date:
+        return '<c s="1"><v>%s</v></c>' % _excel_date(value)
+    if cls is float or cls is Decimal or isinstance(value, numbers.Number):
+        # numpy scalars too, NaN and infinity (e.g. empty numeric cells of parse_batches) are empty cells
+        try:
+            finite = math.isfinite(value)
+        except (TypeError, ValueError):
+            finite = False
+        return '<c><v>%s</v></c>' % value if finite else '<c/>'
+    value = escape(R_XML_ILLEGAL.sub('', force_str(value)))
+    return '<c t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % value
+
+
+def xlsx_row(row):
+    return '<row>%s</row>' % ''.join([xlsx_cell(value) for value in row])
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, datetime.date):
+        return value.strftime('%Y-%m-%d')
+    return value
+
+
+class CSVWriter(object):
+    """ output - file name or text file object """
+
+    def __init__(self, output, **kwargs):
+        self.own = isinstance(output, str)
+        if self.own:
+            mode = 'a' if kwargs.get('append') else 'w'
+            output = io.open(output, mode, encoding=kwargs.get('encoding') or 'utf-8', errors='replace', newline='')
+        self.output = output
+        self.writer = csv.writer(output, delimiter=kwargs.get('delimiter') or ';', lineterminator='\n')
+
+    def writerow(self, row):
+        self.writer.writerow([csv_value(value) for value in row])
+
+    def close(self):
+        if self.own:
+            self.output.close()
+
+
+class XLSXWriter(object):
+    """
+    Streaming xlsx writer: rows are compressed into the worksheet as they come,
+    only the current row is kept in memory. output - file name or binary file object.
+    A new sheet is started with add_sheet() or when the sheet reaches the xlsx limit of rows.
+    """
+
+    def __init__(self, output, **kwargs):
+        if isinstance(output, str):
+            # the file is written from scratch, rows of earlier appends are not continued
+            remove_sidecars(output)
+        self.archive = ZipFile(output, 'w', ZIP_DEFLATED, compresslevel=kwargs.get('compresslevel'))
+        self.sheet_name = kwargs.get('sheet_name') or 'Export'
+        self.sheets = []
+        self.sheet = None
+        self.rows = 0
+        self.archive.writestr('xl/styles.xml', XLSX_STYLES)
+
+    def add_sheet(self, name=None):
+        self._close_sheet()
+        number = len(self.sheets) + 1
+        if not name:
+            name = self.sheet_name if number == 1 else '%s %s' % (self.sheet_name, number)
+        self.sheets.append(name[:31])
+        self.sheet = self.archive.open('xl/worksheets/sheet%s.xml' % number, 'w', force_zip64=True)
+        self.sheet.write(XLSX_SHEET_HEAD.encode('utf8'))
+        self.rows = 0
+
+    def _close_sheet(self):
+        if self.sheet is not None:
+            self.sheet.write(XLSX_SHEET_TAIL.encode('utf8'))
+            self.sheet.close()
+            self.sheet = None
+
+    def writerow(self, row):
+        if self.sheet is None or self.rows >= XLSX_MAX_ROWS:
+            self.add_sheet()
+        self.sheet.write(xlsx_row(row).encode('utf8'))
+        self.rows += 1
+
+    def write_rows(self, source, count):
+        """ Copy count rows of ready utf8 XML (see xlsx_row) from binary file object source """
+        if self.sheet is None or self.rows + count > XLSX_MAX_ROWS:
+            self.add_sheet()
+        shutil.copyfileobj(source, self.sheet, COPY_BUFFER_SIZE)
+        self.rows += count
+
+    def close(self):
+        if self.sheet is None:
+            self.add_sheet()
+        self._close_sheet()
+        numbers = range(1, len(self.sheets) + 1)
+        self.archive.writestr('[Content_Types].xml', XLSX_CONTENT_TYPES % ''.join(
+            XLSX_CONTENT_TYPE_SHEET % number for number in numbers))
+        self.archive.writestr('_rels/.rels', XLSX_RELS)
+        self.archive.writestr('xl/workbook.xml', XLSX_WORKBOOK % ''.join(
+            XLSX_WORKBOOK_SHEET % (escape(name, {'"': '&quot;'}), number, number)
+            for number, name in zip(numbers, self.sheets)))
+        self.archive.writestr('xl/_rels/workbook.xml.rels', XLSX_WORKBOOK_RELS % ''.join(
+            XLSX_WORKBOOK_REL_SHEET % (number, number) for number in numbers))
+        self.archive.close()
+
+
+def remove_sidecars(file_name):
+    """ Remove the sheet part and the state of XLSXAppender of file_name """
+    for name in ('%s.rows' % file_name, '%s.state' % file_name):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+class XLSXAppender(object):
+    """
+    Incremental xlsx export. Rows are rendered once and appended to the sidecar sheet part
+    "<file_name>.rows", its size and the number of rows are kept in "<file_name>.state" (JSON).
+    package() builds the xlsx from the sheet part without rendering earlier rows again.
+    Without state file the sheet part is started from the rows of the existing xlsx file, if any
+    (rendered once). close(finish=True) packages the file and removes the sidecar files. output - file name.
+    """
+
+    def __init__(self, output, **kwargs):
+        self.file_name = output
+        self.part_name = '%s.rows' % output
+        self.state_name = '%s.state' % output
+        self.options = kwargs
+        self.state = dict(rows=0, size=0, sheet_name=kwargs.get('sheet_name') or 'Export')
+        if os.path.exists(self.state_name) and os.path.exists(self.part_name):
+            with open(self.state_name) as f:
+                self.state.update(json.load(f))
+            self.part = open(self.part_name, 'r+b')
+            # rows written after the last saved state (interrupted append) are dropped
+            self.part.truncate(self.state['size'])
+            self.part.seek(self.state['size'])
+        else:
+            self.part = open(self.part_name, 'w+b')
+            if os.path.exists(output):
+                self._seed()
+
+    def _seed(self):
+        # rows of the xlsx written without append (or packaged with finish) are continued
+        book = load_workbook(self.file_name, read_only=True)
+        try:
+            self.state['sheet_name'] = book.worksheets[0].title
+            for sheet in book.worksheets:
+                for row in sheet.iter_rows():
+                    self.writerow([self._cell_value(cell) for cell in row])
+        finally:
+            book.close()
+
+    def writerow(self, row):
+        self.part.write(xlsx_row(row).encode('utf8'))
+        self.state['rows'] += 1
+
+    def _cell_value(self, cell):
+        value = getattr(cell, 'value', None)
+        # openpyxl reads dates as datetimes, date cells are written back as dates
+        if isinstance(value, datetime.datetime) and 'h' not in (cell.number_format or '').lower():
+            return value.date()
+        return value
+
+    def close(self, package=True, finish=False):
+        self.part.flush()
+        os.fsync(self.part.fileno())
+        self.state['size'] = self.part.tell()
+        self.part.close()
+        with open('%s.tmp' % self.state_name, 'w') as f:
+            json.dump(self.state, f)
+        os.replace('%s.tmp' % self.state_name, self.state_name)
+        if package or finish:
+            self.package()
+        if finish:
+            remove_sidecars(self.file_name)
+
+    def package(self):
+        """ Write the xlsx file from the sheet part, earlier rows are copied, not rendered """
+        temp = '%s.tmp' % self.file_name
+        options = dict(self.options, sheet_name=self.state['sheet_name'])
+        writer = XLSXWriter(temp, **options)
+        with open(self.part_name, 'rb') as f:
+            rows = self.state['rows']
+            # the part longer than the xlsx limit is split into sheets
+            while rows > XLSX_MAX_ROWS:
+                writer.add_sheet()
+                for data in self._read_rows(f, XLSX_MAX_ROWS):
+                    writer.sheet.write(data)
+                writer.rows = XLSX_MAX_ROWS
+                rows -= XLSX_MAX_ROWS
+            writer.write_rows(f, rows)
+        writer.close()
+        os.replace(temp, self.file_name)
+
+    def _read_rows(self, f, count):
+        # rows are separated by "</row>", values can not contain it unescaped
+        buffer = b''
+        while count:
+            chunk = f.read(COPY_BUFFER_SIZE)
+            buffer += chunk
+            end = 0
+            while count:
+                position = buffer.find(b'</row>', end)
+                if position < 0:
+                    break
+                end = position + 6
+                count -= 1
+            yield buffer[:end]
+            buffer = buffer[end:]
+            if not chunk:
+                break
+        if buffer:
+            f.seek(-len(buffer), os.SEEK_CUR)
+
+
+class XLSWriter(object):
+    """ Legacy xls writer, a new sheet is started every 65536 rows """
+
+    def __init__(self, output, **kwargs):
+        self.output = output
+        self.workbook = WorkbookOld(encoding=kwargs.get('encoding') or 'utf-8')
+        self.sheet_name = kwargs.get('sheet_name') or 'Export'
+        self.styles = {
+            datetime.date: easyxf(num_format_str='YYYY-MM-DD'),
+            datetime.datetime: easyxf(num_format_str='YYYY-MM-DD HH:MM:SS'),
+        }
+        self.sheet = None
+        self.rows = 0
+
+    def writerow(self, row):
+        if self.rows % XLS_MAX_ROWS == 0:
+            number = self.rows // XLS_MAX_ROWS
+            self.sheet = self.workbook.add_sheet('%s %s' % (self.sheet_name, number + 1) if number else self.sheet_name)
+        r = self.rows % XLS_MAX_ROWS
+        for c, value in enumerate(row):
+            style = self.styles.get(value.__class__)
+            if style:
+                self.sheet.write(r, c, value, style)
+            else:
+                self.sheet.write(r, c, value)
+        self.rows += 1
+
+    def close(self):
+        if self.sheet is None:
+            self.workbook.add_sheet(self.sheet_name)
+        self.workbook.save(self.output)
+
+
+WRITERS = {
+    'csv': CSVWriter,
+    'xlsx': XLSXWriter,
+    'xls': XLSWriter,
+}
+
+
+def get_writer(file_format):
+    try:
+        return WRITERS[file_format or 'csv']
+    except KeyError:
+        raise Exception('Export: wrong file format "%s"' % file_format)
+
+
+def queryset_rows(queryset, columns, header=True):
+    """
+    Rows of queryset by columns: [(title, field name or callable(obj)), ...].
+    Field names may follow relations ("brand__name"). When all columns are field names
+    rows are read with values_list, otherwise objects are fetched in chunks.
+    """
+    if header:
+        yield [force_str(title) for title, field in columns]
+    fields = [field for title, field in columns]
+    if all(isinstance(field, str) for field in fields):
+        for row in queryset.values_list(*fields).iterator(chunk_size=QUERYSET_CHUNK_SIZE):
+            yield row
+        return
+    getters = []
+    for field in fields:
+        if callable(field):
+            getters.append(field)
+        else:
+            getters.append(lambda obj, field=field.replace('__', '.'): get_attribute(obj, field))
+    for obj in queryset.iterator(chunk_size=QUERYSET_CHUNK_SIZE):
+        yield [getter(obj) for getter in getters]
+
+
+def export_rows(rows, **kwargs):
+    """
+    Write iterable of rows (lists of str, int, float, Decimal, date, datetime, bool or None)
+    to file_name, or return the file contents as bytes with in_memory=True.
+    file_format: csv (default), xlsx or xls. CSV options: encoding, delimiter (";"), append.
+    xlsx with append=True adds rows to the previous export (see XLSXAppender), with package=False
+    the xlsx file is not rebuilt, so rows can be appended many times and packaged once,
+    finish=True packages it and removes the sidecar files:
+
+        export_rows(rows, file_name=name, file_format='xlsx', append=True, package=False)
+        ...
+        export_rows([], file_name=name, file_format='xlsx', append=True, finish=True)
+    """
+    writer_class = get_writer(kwargs.get('file_format'))
+    in_memory = kwargs.get('in_memory', False)
+    if writer_class is XLSXWriter and kwargs.get('append') and not in_memory:
+        writer_class = XLSXAppender
+    if in_memory:
+        output = io.BytesIO()
+        if writer_class is CSVWriter:
+            text = io.TextIOWrapper(output, encoding=kwargs.get('encoding') or 'utf-8', errors='replace',
+                                    newline='', write_through=True)
+            writer = writer_class(text, **kwargs)
+        else:
+            writer = writer_class(output, **kwargs)
+    else:
+        writer = writer_class(kwargs['file_name'], **kwargs)
+    for row in rows:
+        writer.writerow(row)
+    if writer_class is XLSXAppender:
+        writer.close(package=kwargs.get('package', True), finish=kwargs.get('finish', False))
+    else:
+        writer.close()
+    if in_memory:
+        return output.getvalue()
+
+
+class StreamBuffer(object):
+    """
+    Write-only file object which keeps the written data until it is taken.
+    Text is encoded with encoding. It has tell() but no seek(), so zipfile writes data descriptors.
+    """
+
+    def __init__(self, encoding=None):
+        self.encoding = encoding
+        self.chunks = []
+        self.size = 0
+        self.position = 0
+
+    def write(self, data):
+        if self.encoding and isinstance(data, str):
+            data = data.encode(self.encoding, errors='replace')
+        else:
+            data = bytes(data)
+        self.chunks.append(data)
+        self.size += len(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+def export_stream(rows=None, **kwargs):
+    """
+    Generator of file content chunks for StreamingHttpResponse, takes the same arguments as export_rows
+    (or queryset and columns instead of rows). CSV and xlsx are yielded as rows are written,
+    xls can not be streamed and is yielded at the end.
+    """
+    if rows is None:
+        rows = queryset_rows(kwargs.pop('queryset'), kwargs.pop('columns'), kwargs.get('header', True))
+    writer_class = get_writer(kwargs.get('file_format'))
+    chunk_size = kwargs.get('chunk_size') or STREAM_CHUNK_SIZE
+    output = StreamBuffer(kwargs.get('encoding') or 'utf-8' if writer_class is CSVWriter else None)
+    writer = writer_class(output, **kwargs)
+    for row in rows:
+        writer.writerow(row)
+        if output.size >= chunk_size:
+            yield output.take()
+    writer.close()
+    data = output.take()
+    if data:
+        yield data
+
+
+def export_response(file_name, rows=None, **kwargs):
+    """ StreamingHttpResponse downloading export_stream(rows, **kwargs) as file_name """
+    file_format = kwargs.get('file_format') or 'csv'
+    content_type = CONTENT_TYPES.get(file_format, 'application/octet-stream')
+    if file_format == 'csv':
+        content_type = '%s; charset=%s' % (content_type, kwargs.get('encoding') or 'utf-8')
+    response = StreamingHttpResponse(export_stream(rows, **kwargs), content_type=content_type)
+    response['Content-Disposition'] = content_disposition(file_name)
+    return response
+
+
+def export_queryset(queryset, columns, **kwargs):
+    """ export_rows of queryset_rows(queryset, columns), header=False skips the titles row """
+    return export_rows(queryset_rows(queryset, columns, kwargs.get('header', True)), **kwargs)
+
+
+def _export_shard(label, query, columns, after, last, file_format, filename, kwargs):
+    # runs in a worker process: the queryset is rebuilt from its model and query
+    queryset = apps.get_model(label)._default_manager.all()
+    queryset.query = query
+    if after is not None:
+        queryset = queryset.filter(pk__gt=after)
+    if last is not None:
+        queryset = queryset.filter(pk__lte=last)
+    rows = queryset_rows(queryset.order_by('pk'), columns, header=False)
+    count = 0
+    if file_format == 'xlsx':
+        # rows XML only, the sheet is compressed by the parent
+        with open(filename, 'wb') as f:
+            for row in rows:
+                f.write(xlsx_row(row).encode('utf8'))
+                count += 1
+    else:
+        writer = CSVWriter(filename, **kwargs)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+        writer.close()
+    return count
+
+
+def export_sharded(queryset, columns, file_name, **kwargs):
+    """
+    Export large queryset (export_queryset) in parallel: the queryset is split into pk ranges
+    of shard_size rows, every shard is rendered by a worker process and shards are joined in pk order.
+    file_format: csv or xlsx; xlsx sheets: "single" (a new sheet only at the xlsx rows limit)
+    or "multi" (sheet per shard). Columns must be field names or picklable (module level) functions.
+    on_progress(done, total, rows) is called after every joined shard. Returns the number of rows.
+    """
+    file_format = kwargs.get('file_format') or 'csv'
+    if file_format not in ('csv', 'xlsx'):
+        raise Exception('Export: wrong file format "%s" for sharded export' % file_format)
+    workers = kwargs.get('workers') or os.cpu_count() or 1
+    shard_size = kwargs.get('shard_size') or 50000
+    multi = kwargs.get('sheets') == 'multi'
+    header = [force_str(title) for title, field in columns] if kwargs.get('header', True) else None
+    on_progress = kwargs.get('on_progress')
+    options = dict((key, kwargs[key]) for key in ('encoding', 'delimiter') if key in kwargs)
+    ranges = list(queryset_pk_ranges(queryset, chunksize=shard_size))
+    directory = tempfile.mkdtemp()
+    label = queryset.model._meta.label
+    total = 0
+    close_connections_before_fork()
+    try:
+        if file_format == 'xlsx':
+            writer = XLSXWriter(file_name, **kwargs)
+        else:
+            writer = CSVWriter(file_name, **options)
+        if header and not multi:
+            writer.writerow(header)
+        if file_format == 'csv':
+            writer.close()
+        with ProcessPoolExecutor(workers) as pool:
+            futures = []
+            for number, (after, last) in enumerate(ranges):
+                filename = os.path.join(directory, '%s.part' % number)
+                futures.append((pool.submit(_export_shard, label, queryset.query, columns, after, last,
+                                            file_format, filename, options), filename))
+            for number, (future, filename) in enumerate(futures, start=1):
+                count = future.result()
+                with open(filename, 'rb') as f:
+                    if file_format == 'xlsx':
+                        if multi:
+                            writer.add_sheet()
+                            if header:
+                                writer.writerow(header)
+                        writer.write_rows(f, count)
+                    else:
+                        with open(file_name, 'ab') as output:
+                            shutil.copyfileobj(f, output, COPY_BUFFER_SIZE)
+                os.remove(filename)
+                total += count
+                if on_progress:
+                    on_progress(number, len(futures), total)
+        if file_format == 'xlsx':
+            writer.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return total
+
 
 def export_to_file(**kwargs):
+    """
+    Template export: the template renders lines of ";" separated values, typed values are marked
+    as "decimal:1.5", "integer:1", "date:2020-01-31" or "datetime:2020-01-31 10:00:00".
+    With rows (or queryset and columns) instead of template the data is exported by export_rows.
+    """
+    if 'template' not in kwargs:
+        if 'rows' in kwargs:
+            return export_rows(kwargs.pop('rows'), **kwargs)
+        return export_queryset(kwargs.pop('queryset'), kwargs.pop('columns'), **kwargs)
+
     RE_DECIMAL = re.compile(r'^decimal:([\d\.\,]+)$')
     RE_INTEGER = re.compile(r'^integer:(\d+)$')
     RE_DATE = re.compile(r'^date:(.+)$')
@@ -31,6 +627,7 @@ def export_to_file(**kwargs):
             if r:
                 dt = datetime.datetime.strptime(r.group(1), '%Y-%m-%d').date()
                 result.append(dt)
+                continue
             r = RE_DATETIME.match(item)
             if r:
                 dt = datetime.datetime.strptime(r.group(1), '%Y-%m-%d %H:%M:%S')
@@ -52,34 +649,10 @@ def export_to_file(**kwargs):
         variables['mark_unsafe'] = True
     data = render_to_string(template, variables)
     data = data.rstrip('\n')
-    if file_format == 'xlsx':
-        wb = Workbook()
-        ws = wb.new_sheet("Export")
-        ws_row = 1
-        for line in data.split('\n'):
-            for i, data in enumerate(_process_line(line), start=1):
-                ws.set_cell_value(ws_row, i, data)
-            ws_row += 1
-        if in_memory:
-            f = tempfile.NamedTemporaryFile(delete=False)
-            file_name = f.name
-            f.close()
-        wb.save(file_name)
-        if in_memory:
-            return open(file_name, 'rb').read()
-    elif file_format == 'xls':
-        wb = WorkbookOld()
-        ws = wb.add_sheet('0')
-        for r, line in enumerate(data.split('\n'), start=1):
-            for c, l in enumerate(_process_line(line)):
-                ws.write(r, c, l)
-        if in_memory:
-            f = tempfile.NamedTemporaryFile(delete=False)
-            file_name = f.name
-            f.close()
-        wb.save(file_name)
-        if in_memory:
-            return open(file_name, 'rb').read()
+    if file_format in ('xlsx', 'xls'):
+        return export_rows((_process_line(line) for line in data.split('\n')),
+                           file_name=file_name, file_format=file_format, in_memory=in_memory,
+                           append=append)
     else:
         if in_memory:
             return smart_bytes(data, encoding, errors='replace')
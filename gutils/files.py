@@ -1,6 +1,6 @@
 from django.utils.encoding import force_str, force_bytes
 from django.conf import settings
-from gutils.archiver import unpack_file
+from gutils.archiver import unpack_file, ArchiveMember
 from gutils.strings import get_slug
 import shutil
 import random
@@ -9,6 +9,8 @@ import os
 
 
 bufsize = 8096
+# archive members Reader reads as a stream, others (xls, xlsx, dbf) are loaded into memory and are unpacked
+STREAMED_EXTENSIONS = ('.csv', '.txt', '.html', '')
 
 
 def file_generate_name():
@@ -59,12 +61,38 @@ def create_directory(filename):
 
 
 def upload_file(post_file, file_path, file_name=''):
+    """
+    Save uploaded file, archives are unpacked. zip and gz archives of csv, txt and html files Reader
+    can read directly (e.g. price.csv.gz) are kept compressed, so the data is written to disk only once.
+    """
     name = post_file.name.lower()
     name, ext = os.path.splitext(name)
     name = "%s%s" % (get_slug(name) or 'unknown', ext)
+    # extension of the compressed file: price.csv.gz
+    inner_ext = os.path.splitext(post_file.name[:-len(ext)])[1].lower() if ext in ('.gz', '.gzip') else ''
     if not file_name:
         file_name = os.path.splitext(post_file.name)[0].lower()
-    if ext in ('.rar', '.zip', '.7z', '.gz', '.gzip'):
+        if inner_ext:
+            file_name = file_name[:-len(inner_ext)]
+    if ext in ('.zip', '.gz', '.gzip'):
+        if ext == '.zip':
+            destination = '%s.zip' % file_name
+        else:
+            destination = '%s%s.gz' % (file_name, inner_ext or '.csv')
+        destination = os.path.join(file_path, destination).replace('\\', '/')
+        file_save_uploaded(post_file, destination)
+        try:
+            member = ArchiveMember(destination)
+            streamed = member.readable and os.path.splitext(member.name)[1].lower() in STREAMED_EXTENSIONS
+        except Exception:
+            streamed = False
+        if streamed:
+            return destination
+        try:
+            return unpack_file(destination, file_path, file_name)
+        finally:
+            os.remove(destination)
+    if ext in ('.rar', '.7z'):
         temp = os.path.join(file_path, name).replace('\\', '/')
         file_save_uploaded(post_file, temp)
         _name = unpack_file(temp, file_path, file_name)
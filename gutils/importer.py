@@ -0,0 +1,199 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from gutils import Struct
+from gutils.db import close_connections_before_fork
+from gutils.archiver import unpack_file, archive_type, ArchiveMember, ARCHIVE_EXTENSIONS
+from gutils.reader import Reader
+from gutils.strings import get_slug
+from gutils.systems import smart_download
+from collections import deque
+import tempfile
+import shutil
+import time
+import re
+import os
+
+QUEUED = 'queued'
+DOWNLOADING = 'downloading'
+PARSING = 'parsing'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def download_file(url, directory, name, **kwargs):
+    """ Download url into directory, returns saved filename """
+    ext = os.path.splitext(re.sub(r'\?.+', '', url))[1].lower()
+    save_to = os.path.join(directory, '%s%s' % (get_slug(name) or 'unknown', ext))
+    kwargs.setdefault('detect_extension', True)
+    result = smart_download(url, save_to=save_to, **kwargs)
+    if result.error:
+        raise Exception(result.error)
+    return result.file_name
+
+
+def import_file(filename, **kwargs):
+    """
+    Unpack (for archives) and parse one file, runs in a worker process.
+    handler(name, rows) receives the parsed rows iterator and must be picklable (module level function),
+    without handler rows are only counted.
+    Archives Reader can not read are unpacked into directory, without it into a temporary directory
+    removed after the parse.
+    """
+    name = kwargs.get('name') or os.path.basename(filename)
+    handler = kwargs.get('handler')
+    directory = kwargs.get('directory')
+    temporary = None
+    started = time.time()
+    try:
+        # zip, gz and tar are read by Reader without extracting
+        readable = archive_type(filename) and ArchiveMember(filename, password=kwargs.get('password', '')).readable
+        if filename.lower().endswith(ARCHIVE_EXTENSIONS) and not readable:
+            if not directory:
+                directory = temporary = tempfile.mkdtemp()
+            unpacked = unpack_file(filename, directory, get_slug(name) or 'unknown',
+                                   password=kwargs.get('password', ''))
+            if not unpacked:
+                raise Exception('Archive "%s" is empty' % filename)
+            filename = unpacked
+        reader = Reader(filename, **dict({'password': kwargs.get('password', '')}, **kwargs.get('reader', {})))
+        counter = Struct(rows=0)
+
+        def rows():
+            for row in reader.parse(struct=kwargs.get('struct'), required=kwargs.get('required', [])):
+                counter.rows += 1
+                yield row
+
+        result = None
+        if handler:
+            result = handler(name, rows())
+        else:
+            for row in rows():
+                pass
+    finally:
+        if temporary:
+            shutil.rmtree(temporary, ignore_errors=True)
+    return Struct(filename=filename, rows=counter.rows, errors=reader.errors, result=result,
+                  parse_time=time.time() - started)
+
+
+class ImportScheduler(object):
+    """
+    Import many supplier files as a pipeline: download (threads) -> unpack and parse (processes).
+
+        scheduler = ImportScheduler(downloads=8, workers=4, on_progress=log)
+        scheduler.add('supplier1', 'http://example.com/price.zip', struct={'code': 1, 'price': (3, 'decimal')},
+                      required=['code'], handler=save_prices)
+        scheduler.add('supplier2', '/var/prices/supplier2.xlsx', struct=...)
+        report = scheduler.run()
+
+    Every stage has its own concurrency, no more than max_pending files are downloading or waiting
+    for parse at the same time, so a slow parse stage stops new downloads instead of filling the disk.
+    Files are handled independently: the slowest supplier does not hold up the others.
+    on_progress(task) is called in the caller's thread on every status change of a task.
+    Files are downloaded and unpacked into directory, without it into a temporary directory
+    removed when run() ends.
+    """
+
+    def __init__(self, **kwargs):
+        self.downloads = kwargs.get('downloads', 4)
+        self.workers = kwargs.get('workers') or os.cpu_count() or 1
+        self.max_pending = max(kwargs.get('max_pending') or self.workers * 2, 1)
+        self.directory = kwargs.get('directory')
+        self.on_progress = kwargs.get('on_progress')
+        self.tasks = []
+
+    def add(self, name, source, **kwargs):
+        """
+        Add file to import, source is URL or local filename.
+        kwargs: struct, required, handler, password (archives), reader (Reader kwargs),
+        download (smart_download kwargs).
+        """
+        task = Struct(name=name,
+                      source=source,
+                      options=kwargs,
+                      status=QUEUED,
+                      filename='',
+                      rows=0,
+                      errors=[],
+                      error='',
+                      result=None,
+                      download_time=0,
+                      parse_time=0)
+        self.tasks.append(task)
+        return task
+
+    def _is_url(self, source):
+        return bool(re.match(r'^(https?|ftp)://', source, flags=re.I))
+
+    def _set_status(self, task, status):
+        task.status = status
+        if self.on_progress:
+            self.on_progress(task)
+
+    def _parse(self, pool, task, directory):
+        options = dict(task.options)
+        options.pop('download', None)
+        task.started = time.time()
+        self._set_status(task, PARSING)
+        return pool.submit(import_file, task.filename, name=task.name, directory=directory, **options)
+
+    def run(self):
+        """ Run all added tasks, returns summary report """
+        started = time.time()
+        close_connections_before_fork()
+        directory = self.directory or tempfile.mkdtemp()
+        try:
+            waiting = deque(task for task in self.tasks if task.status == QUEUED)
+            downloading = {}
+            parsing = {}
+            with ThreadPoolExecutor(self.downloads) as downloader, ProcessPoolExecutor(self.workers) as pool:
+                while waiting or downloading or parsing:
+                    while waiting and len(downloading) + len(parsing) < self.max_pending:
+                        task = waiting.popleft()
+                        if self._is_url(task.source):
+                            task.started = time.time()
+                            self._set_status(task, DOWNLOADING)
+                            future = downloader.submit(download_file, task.source, directory, task.name,
+                                                       **task.options.get('download', {}))
+                            downloading[future] = task
+                        else:
+                            task.filename = task.source
+                            parsing[self._parse(pool, task, directory)] = task
+                    done, not_done = wait(list(downloading) + list(parsing), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if future in downloading:
+                            task = downloading.pop(future)
+                            task.download_time = time.time() - task.started
+                            try:
+                                task.filename = future.result()
+                            except Exception as e:
+                                task.error = str(e)
+                                self._set_status(task, FAILED)
+                                continue
+                            parsing[self._parse(pool, task, directory)] = task
+                        else:
+                            task = parsing.pop(future)
+                            task.parse_time = time.time() - task.started
+                            try:
+                                result = future.result()
+                            except Exception as e:
+                                task.error = str(e)
+                                self._set_status(task, FAILED)
+                                continue
+                            task.filename = result.filename
+                            task.parse_time = result.parse_time
+                            task.rows = result.rows
+                            task.errors = result.errors
+                            task.result = result.result
+                            self._set_status(task, DONE)
+        finally:
+            if not self.directory:
+                shutil.rmtree(directory, ignore_errors=True)
+        return self.report(time.time() - started)
+
+    def report(self, seconds=0):
+        return Struct(total=len(self.tasks),
+                      done=len([task for task in self.tasks if task.status == DONE]),
+                      failed=len([task for task in self.tasks if task.status == FAILED]),
+                      rows=sum(task.rows for task in self.tasks),
+                      seconds=seconds,
+                      tasks=self.tasks)
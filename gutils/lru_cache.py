@@ -1,23 +1,224 @@
+import sys
 import time
+import weakref
+import datetime
 import functools
+import itertools
 import collections
-from threading import RLock
+from threading import RLock, Event, get_ident
+from decimal import Decimal
+from django.conf import settings
 from django.utils.encoding import force_str
 
+# expired entries checked from the least recently used end on every insert
+SWEEP_SIZE = 8
+# argument types used in keys as they are, 1 and '1' are different keys
+FAST_TYPES = frozenset([str, int])
+# hashable argument types used in keys with a type tag (1, 1.0 and True are different keys)
+HASHABLE_TYPES = frozenset([float, bool, bytes, type(None), Decimal, datetime.date, datetime.datetime])
+KEY_MARK = object()
+NOT_SET = object()
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'expired', 'maxsize', 'currsize'])
+
+
+def _key_part(value):
+    cls = value.__class__
+    if cls in FAST_TYPES:
+        return value
+    if cls in HASHABLE_TYPES:
+        return cls, value
+    meta = getattr(value, '_meta', None)
+    pk = getattr(value, 'pk', None)
+    if pk is not None:
+        # model instances by model and primary key
+        return (meta.label if meta is not None else cls), pk
+    return cls, force_str(value)
+
+
+def make_key(args, kwargs):
+    """
+    Cache key of call arguments: a single str or int argument is the key itself,
+    str and int arguments are a tuple, other calls are a tuple of type tagged parts.
+    """
+    if not kwargs:
+        if len(args) == 1 and args[0].__class__ in FAST_TYPES:
+            return args[0]
+        for arg in args:
+            if arg.__class__ not in FAST_TYPES:
+                break
+        else:
+            return args
+    key = [KEY_MARK]
+    key.extend(map(_key_part, args))
+    for name in sorted(kwargs):
+        key.append(name)
+        key.append(_key_part(kwargs[name]))
+    return tuple(key)
+
+
+def approx_size(value):
+    """
+    Approximate size of value in bytes: sys.getsizeof of the value and of the items of lists, tuples, sets,
+    dicts and instance attributes, one level deep.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(map(sys.getsizeof, value))
+    elif isinstance(value, dict):
+        size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in value.items())
+    elif hasattr(value, '__dict__'):
+        size += sys.getsizeof(value.__dict__) + sum(map(sys.getsizeof, value.__dict__.values()))
+    return size
+
+
+class _CallerCache(collections.OrderedDict):
+    """ Values of one caller {key: (value, expire time or None)}, the most recently used are at the end """
+
+    def __init__(self, owner=None):
+        super(_CallerCache, self).__init__()
+        # id of the instance, a shallow copy of the instance shares its __dict__ values, but not its cache
+        self.owner = id(owner)
+
+    def __reduce__(self):
+        # kept in instance __dict__: pickled and copied instances (e.g. models put into the Django cache) get an empty cache
+        return self.__class__, ()
+
+
+class _Budget(object):
+    """
+    Bytes limit shared by all lru_cache functions: when the approximate size of all cached values is over max_bytes,
+    the least recently used values are dropped, whatever function they belong to.
+    max_bytes is settings.GUTILS_LRU_CACHE_MAX_BYTES or set_max_bytes(), None - no limit.
+    """
+
+    def __init__(self):
+        self.lock = RLock()
+        self.max_bytes = NOT_SET
+        self.size = 0
+        # {(id(caller cache), key): (id(item), size)}, the most recently used are at the end,
+        #   items are not referenced: a value referring to its instance must not keep the instance alive
+        self.entries = collections.OrderedDict()
+        # {id(caller cache): (weak reference to caller cache, LRU_Cache, set of keys)}
+        self.caches = {}
+
+    def limit(self):
+        if self.max_bytes is NOT_SET:
+            self.max_bytes = getattr(settings, 'GUTILS_LRU_CACHE_MAX_BYTES', None) if settings.configured else None
+        return self.max_bytes
+
+    def add(self, owner, caller_cache, key, item):
+        if self.limit() is None:
+            return
+        size = approx_size(key) + approx_size(item[0])
+        cache_id = id(caller_cache)
+        with self.lock:
+            cache = self.caches.get(cache_id)
+            if cache is None:
+                ref = weakref.ref(caller_cache, functools.partial(self._forget, cache_id))
+                cache = self.caches[cache_id] = (ref, owner, set())
+            cache[2].add(key)
+            old = self.entries.pop((cache_id, key), None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[(cache_id, key)] = (id(item), size)
+            self.size += size
+
+    def touch(self, caller_cache, key):
+        if self.limit() is None:
+            return
+        with self.lock:
+            try:
+                self.entries.move_to_end((id(caller_cache), key))
+            except KeyError:
+                pass
+
+    def remove(self, caller_cache, key):
+        cache_id = id(caller_cache)
+        with self.lock:
+            entry = self.entries.pop((cache_id, key), None)
+            if entry is not None:
+                self.size -= entry[1]
+                self.caches[cache_id][2].discard(key)
+
+    def _forget(self, cache_id, ref):
+        # the caller cache is deleted (cache_clear or the instance is gone)
+        with self.lock:
+            cache = self.caches.get(cache_id)
+            if cache is None or cache[0] is not ref:
+                return
+            del self.caches[cache_id]
+            for key in cache[2]:
+                self.size -= self.entries.pop((cache_id, key))[1]
+
+    def shrink(self):
+        # Only one lock is held at a time: functions lock their own cache first and the budget after it
+        while True:
+            with self.lock:
+                if self.max_bytes is None or self.max_bytes is NOT_SET or self.size <= self.max_bytes:
+                    return
+                (cache_id, key), (item_id, size) = self.entries.popitem(False)
+                self.size -= size
+                ref, owner, keys = self.caches[cache_id]
+                keys.discard(key)
+            caller_cache = ref()
+            if caller_cache is not None:
+                with owner.lock:
+                    if id(caller_cache.get(key)) == item_id:
+                        del caller_cache[key]
+                        owner.evictions += 1
+            del caller_cache
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.caches.clear()
+            self.size = 0
+
+
+budget = _Budget()
+
+
+def set_max_bytes(max_bytes):
+    """ Set the bytes limit of all lru_cache values (None - no limit), values over it are dropped at once """
+    with budget.lock:
+        budget.max_bytes = max_bytes
+        if max_bytes is None:
+            budget.clear()
+    budget.shrink()
+
+
+class _Flight(object):
+    """ Value being computed by one thread, the other threads wait for it """
+
+    def __init__(self):
+        self.thread = get_ident()
+        self.event = Event()
+        self.value = None
+        self.error = None
+
 
 def lru_cache(maxsize=255, timeout=None):
     """lru_cache(maxsize = 255, timeout = None) --> returns a decorator which returns an instance (a descriptor).
 
         Purpose         - This decorator factory will wrap a function / instance method and will supply a caching mechanism to the function.
-                            For every given input params it will store the result in a queue of maxsize size, and will return a cached ret_val
+                            For every given input params it will store the result in a cache of maxsize size, and will return a cached ret_val
                             if the same parameters are passed.
 
-        Params          - maxsize - int, the cache size limit, anything added above that will delete the first values enterred (FIFO).
+        Params          - maxsize - int, the cache size limit, anything added above that will delete the least recently used values (LRU).
                             This size is per instance, thus 1000 instances with maxsize of 255, will contain at max 255K elements.
-                        - timeout - int / float / None, every n seconds the cache is deleted, regardless of usage. If None - cache will never be refreshed.
+                        - timeout - int / float / None, every value expires n seconds after it was stored. If None - values never expire.
+                            Expired values are dropped when read and by a small sweep of the least recently used values on every insert.
 
-        Notes           - If an instance method is wrapped, each instance will have it's own cache and it's own timeout.
+        Notes           - If an instance method is wrapped, each instance will have it's own cache.
                         - The wrapped function will have a cache_clear variable inserted into it and may be called to clear it's specific cache.
+                        - cache_info() returns CacheInfo(hits, misses, evictions, expired, maxsize, currsize), counters are shared by all instances.
+                        - The cache of an instance is kept in the instance __dict__ and is deleted together with the instance.
+                            Instances without __dict__ are weak referenced (or kept while the cache exists, if they can not be).
+                        - settings.GUTILS_LRU_CACHE_MAX_BYTES (or set_max_bytes()) limits the approximate size of the values of all
+                            decorated functions together, the least recently used values of any function are dropped over it.
+                        - Thread safe: a missing value is computed by one thread, the other threads calling with the same arguments wait
+                            for it (single flight) and get the same value or exception. The function itself is called outside the lock.
                         - The wrapped function will maintain the original function's docstring and name (wraps)
                         - The type of the wrapped function will no longer be that of a function but either an instance of LRU_Cache or a functool.partial type.
 
@@ -31,21 +232,76 @@ def lru_cache(maxsize=255, timeout=None):
             self._max_size = max_size
             self._timeout = timeout
             self.lock = RLock()
-            # This will store the cache for this function, format - {caller1 : [OrderedDict1, last_refresh_time1], caller2 : [OrderedDict2, last_refresh_time2]}.
-            #   In case of an instance method - the caller is the instance, in case called from a regular function - the caller is None.
-            self._caches = {}
+            # In case of an instance method - the caller is the instance, its cache is kept in the instance __dict__,
+            #   so it is deleted together with the instance, even when a cached value refers to the instance.
+            #   Instances without __dict__ and classes are kept in _caches, format - {caller1 : _CallerCache1, caller2 : _CallerCache2},
+            #   by weak reference if possible, otherwise in _strong_caches.
+            #   In case called from a regular function the cache is _function_cache.
+            self._attribute = '_lru_cache:%s.%s' % (input_func.__module__, input_func.__qualname__)
+            self._caches = weakref.WeakKeyDictionary()
+            self._strong_caches = {}
+            self._function_cache = None
+            # values being computed: {(caller, key): _Flight}
+            self._flights = {}
+            self.hits = self.misses = self.evictions = self.expired = 0
+
+        def _attributes(self, caller):
+            # writable __dict__ of the instance, classes (classmethods) have read-only mappingproxy
+            attributes = getattr(caller, '__dict__', None)
+            return attributes if type(attributes) is dict else None
+
+        def _get_cache(self, caller):
+            if caller is None:
+                return self._function_cache
+            attributes = self._attributes(caller)
+            if attributes is not None:
+                caller_cache = attributes.get(self._attribute)
+                if caller_cache is not None and caller_cache.owner == id(caller):
+                    return caller_cache
+                return None
+            try:
+                return self._caches.get(caller)
+            except TypeError:
+                return self._strong_caches.get(caller)
+
+        def _new_cache(self, caller):
+            caller_cache = _CallerCache(caller)
+            if caller is None:
+                self._function_cache = caller_cache
+            elif self._attributes(caller) is not None:
+                caller.__dict__[self._attribute] = caller_cache
+            else:
+                try:
+                    self._caches[caller] = caller_cache
+                except TypeError:
+                    self._strong_caches[caller] = caller_cache
+            return caller_cache
 
         def cache_clear(self, caller=None):
             # Remove the cache for the caller, only if exists:
             with self.lock:
-                if caller in self._caches:
-                    del self._caches[caller]
-                    self._caches[caller] = [collections.OrderedDict(), time.time()]
+                if caller is None:
+                    self._function_cache = None
+                    return
+                attributes = self._attributes(caller)
+                if attributes is not None:
+                    attributes.pop(self._attribute, None)
+                    return
+                try:
+                    self._caches.pop(caller, None)
+                except TypeError:
+                    self._strong_caches.pop(caller, None)
+
+        def cache_info(self, caller=None):
+            with self.lock:
+                return CacheInfo(self.hits, self.misses, self.evictions, self.expired, self._max_size,
+                                 len(self._get_cache(caller) or ()))
 
         def __get__(self, obj, objtype):
             """ Called for instance methods """
             return_func = functools.partial(self._cache_wrapper, obj)
             return_func.cache_clear = functools.partial(self.cache_clear, obj)
+            return_func.cache_info = functools.partial(self.cache_info, obj)
             # Return the wrapped function and wraps it to maintain the docstring and the name of the original function:
             return functools.wraps(self._input_func)(return_func)
 
@@ -56,40 +312,95 @@ def lru_cache(maxsize=255, timeout=None):
         # Set the cache_clear function in the __call__ operator:
         __call__.cache_clear = cache_clear
 
+        def _drop(self, caller_cache, key):
+            del caller_cache[key]
+            if budget.max_bytes is not None:
+                budget.remove(caller_cache, key)
+
+        def _sweep(self, caller_cache, now):
+            # Drop expired values among the least recently used ones, the check is bounded by SWEEP_SIZE
+            expired = [key for key, (value, expires) in itertools.islice(caller_cache.items(), SWEEP_SIZE)
+                       if expires is not None and expires <= now]
+            for key in expired:
+                self._drop(caller_cache, key)
+            self.expired += len(expired)
+
         def _cache_wrapper(self, caller, *args, **kwargs):
             # Create a unique key including the types (in order to differentiate between 1 and '1'):
+            key = make_key(args, kwargs)
 
-            def as_text(obj):
-                result = getattr(obj, 'pk', None)
-                if result is not None:
-                    return force_str(result)
-                return force_str(obj)
-
-            kwargs_key = "".join(map(lambda x: force_str(x) + force_str(type(kwargs[x])) + as_text(kwargs[x]), sorted(kwargs)))
-            key = u"".join(map(lambda x: force_str(type(x)) + as_text(x), args)) + kwargs_key
-            # Check if caller exists, if not create one:
-            if caller not in self._caches:
-                self._caches[caller] = [collections.OrderedDict(), time.time()]
-            else:
-                # Validate in case the refresh time has passed:
-                if self._timeout is not None:
-                    if time.time() - self._caches[caller][1] > self._timeout:
-                        self.cache_clear(caller)
-
-            # Check if the key exists, if so - return it:
-            caller_cache = self._caches[caller][0]
-            if key in caller_cache:
-                return caller_cache[key]
-
-            # Validate we didn't exceed the max_size:
-            if len(caller_cache) >= self._max_size:
-                # Delete the first item in the dict:
-                caller_cache.popitem(False)
-
-            # Call the function and store the data in the cache (call it with the caller in case it's an instance function - Ternary condition):
+            flight_key = (caller, key)
             with self.lock:
-                caller_cache[key] = self._input_func(caller, *args, **kwargs) if caller is not None else self._input_func(*args, **kwargs)
-            return caller_cache[key]
+                now = time.time()
+                caller_cache = self._get_cache(caller)
+                if caller_cache is not None:
+                    item = caller_cache.get(key)
+                    if item is not None:
+                        value, expires = item
+                        if expires is None or expires > now:
+                            # Mark the key as the most recently used:
+                            caller_cache.move_to_end(key)
+                            if budget.max_bytes is not None:
+                                budget.touch(caller_cache, key)
+                            self.hits += 1
+                            return value
+                        self._drop(caller_cache, key)
+                        self.expired += 1
+                flight = self._flights.get(flight_key)
+                owner = flight is None
+                if owner:
+                    flight = self._flights[flight_key] = _Flight()
+                    self.misses += 1
+                elif flight.thread != get_ident():
+                    self.hits += 1
+
+            if not owner:
+                if flight.thread == get_ident():
+                    # recursive call with the same arguments, waiting would never end
+                    return self._call(caller, args, kwargs)
+                flight.event.wait()
+                if flight.error is not None:
+                    raise flight.error
+                return flight.value
+
+            try:
+                value = self._call(caller, args, kwargs)
+            except BaseException as e:
+                with self.lock:
+                    del self._flights[flight_key]
+                flight.error = e
+                flight.event.set()
+                raise
+
+            # the waiting threads get the value even if storing it fails
+            flight.value = value
+            try:
+                with self.lock:
+                    try:
+                        now = time.time()
+                        caller_cache = self._get_cache(caller)
+                        if caller_cache is None:
+                            caller_cache = self._new_cache(caller)
+                        if self._timeout is not None:
+                            self._sweep(caller_cache, now)
+                        # Validate we didn't exceed the max_size, delete the least recently used items:
+                        while caller_cache and len(caller_cache) >= self._max_size:
+                            self._drop(caller_cache, next(iter(caller_cache)))
+                            self.evictions += 1
+                        item = caller_cache[key] = (value, now + self._timeout if self._timeout is not None else None)
+                        budget.add(self, caller_cache, key, item)
+                    finally:
+                        del self._flights[flight_key]
+            finally:
+                flight.event.set()
+            if budget.max_bytes is not None:
+                # Drop the least recently used values of all functions over the bytes limit
+                budget.shrink()
+            return value
+
+        def _call(self, caller, args, kwargs):
+            # Call the function (call it with the caller in case it's an instance function - Ternary condition):
+            return self._input_func(caller, *args, **kwargs) if caller is not None else self._input_func(*args, **kwargs)
 
     # Return the decorator wrapping the class (also wraps the instance to maintain the docstring and the name of the original function):
     return (lambda input_func: functools.wraps(input_func)(LRU_Cache(input_func, maxsize, timeout)))
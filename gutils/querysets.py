@@ -62,6 +62,25 @@ def queryset_part_iterator(queryset, pk='pk', chunksize=50000):
         chunk = list(queryset.filter(**{pk + '__gt': last_pk})[:chunksize])
 
 
+def queryset_pk_ranges(queryset, pk='pk', chunksize=50000):
+    """
+    Split queryset into (after, last) pk ranges of chunksize rows: pk > after and pk <= last,
+    after is None for the first range and last is None for the final one.
+    Only range boundaries are fetched, the same keyset walk as queryset_part_iterator.
+    """
+    queryset = queryset.order_by(pk)
+    after = None
+    while True:
+        part = queryset if after is None else queryset.filter(**{pk + '__gt': after})
+        last = list(part.values_list(pk, flat=True)[chunksize - 1:chunksize])
+        if not last:
+            if part.exists():
+                yield after, None
+            return
+        yield after, last[0]
+        after = last[0]
+
+
 def values_iterator(queryset, chunksize=50000, fields=['pk'], key='pk'):
     pk = 0
     if key not in fields:
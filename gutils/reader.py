@@ -1,43 +1,88 @@
-import shutil
-
 from django.utils.translation import gettext as _
 from django.utils.encoding import force_str
-from openpyxl.reader.excel import load_workbook
+from openpyxl.reader.excel import ExcelReader as OpenpyxlReader
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format, is_timedelta_format
+from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900, from_excel, from_ISO8601
 from django.utils.functional import cached_property
 from gutils import Struct
+from gutils.lru_cache import lru_cache
+from gutils.archiver import ArchiveMember, archive_type
+from gutils.dates import to_date
+from gutils.strings import clean_phone, get_slug
 import mmap
+from struct import unpack
+import datetime
+from decimal import Decimal
 import dbf
 import xlrd
 import re
 import csv
 import os
-import copy
-import tempfile
+import io
+import itertools
+import operator
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque, Counter
+import posixpath
+from zipfile import ZipFile
+from xml.etree import ElementTree
 from _csv import Error as CSVError
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
-R_0 = re.compile(r'\.0$')
+R_HTML_TAG = re.compile(r'<(/?)(tr|td)\b[^>]*>', re.I)
+HTML_CHUNK_SIZE = 1024 * 1024
 MAX_ERRORS = 30
+FIELD_MISSING = 0
+FIELD_EMPTY = 1
+FIELD_WRONG = 2
+COERCE_BATCH_SIZE = 1000
+COERCE_CACHE_SIZE = 10000
+WRONG_VALUE = object()
+R_NOT_DECIMAL = re.compile(r'[^\d\.\-]')
+XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+XLSX_REL_ID = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+XLSX_RELATIONSHIP = '{http://schemas.openxmlformats.org/package/2006/relationships}Relationship'
+XLSX_SHEET_DATA = XLSX_NS + 'sheetData'
+XLSX_ROW = XLSX_NS + 'row'
+XLSX_CELL = XLSX_NS + 'c'
+XLSX_VALUE = XLSX_NS + 'v'
+XLSX_TEXT = XLSX_NS + 't'
+XLSX_RUN = XLSX_NS + 'r'
+XLSX_STRING = XLSX_NS + 'si'
+COUNT_BLOCK_SIZE = 16 * 1024 * 1024
+COUNT_SAMPLE_SIZE = 4 * 1024 * 1024
+PARSE_CHUNK_SIZE = 4 * 1024 * 1024
+SNIFF_LINES = 500
+SNIFF_SIZE = 256 * 1024
+
+
+def _bytes_except(chars):
+    return bytes(c for c in range(256) if c not in chars)
+
+
+# translate() tables: deleting every other byte leaves only the bytes to count
+NOT_DOS_BYTES = _bytes_except(set(range(0x80, 0xB0)) | set(range(0xE0, 0xF0)))
+NOT_WIN_BYTES = _bytes_except(set(range(0xC0, 0x100)))
+DELIMITERS = b';\t,:'
+NOT_DELIMITERS = _bytes_except(set(DELIMITERS))
 
 
 def detect_encoding(value, force_cp1251=False):
-    dos = list(range(0x80, 0xB0)) + list(range(0xE0, 0xF0))
-    win = list(range(0xC0, 0x100))
-    win_count = dos_count = 0
     if not force_cp1251:
         try:
             value.decode('utf8')
             return 'utf8'
         except Exception:
             pass
-    for char in value:
-        if not isinstance(char, int):
-            char = ord(char)
-        if char in dos:
-            dos_count += 1
-        if char in win:
-            win_count += 1
-
+    if isinstance(value, str):
+        value = value.encode('latin1', errors='ignore')
+    dos_count = len(value.translate(None, NOT_DOS_BYTES))
+    win_count = len(value.translate(None, NOT_WIN_BYTES))
     if win_count >= dos_count:
         return 'cp1251'
     else:
@@ -45,11 +90,9 @@ def detect_encoding(value, force_cp1251=False):
 
 
 def detect_delimiter(raw_value):
-    delimiters = {b';': 0, b'\t': 0, b',': 0, b':': 0}
-    for char in delimiters.keys():
-        delimiters[char] = raw_value.count(char)
-    res = sorted(delimiters, key=delimiters.get, reverse=True)
-    return force_str(res[0])
+    counts = Counter(raw_value.translate(None, NOT_DELIMITERS))
+    # on a tie the first delimiter in DELIMITERS wins
+    return force_str(bytes([max(DELIMITERS, key=lambda c: counts[c])]))
 
 
 def detect_quoting(raw_value):
@@ -59,31 +102,333 @@ def detect_quoting(raw_value):
     return csv.QUOTE_NONE
 
 
-def count_lines(filename):
-    if not os.path.getsize(filename):
-        return 0
-    f = open(filename, "r+")
-    buf = mmap.mmap(f.fileno(), 0)
+def open_source(filename, source=None):
+    """ Binary file object of the file or of the archive member (source) """
+    if source is not None:
+        return source.open()
+    return open(filename, 'rb')
+
+
+def read_head(filename, lines=SNIFF_LINES, size=SNIFF_SIZE, source=None):
+    """ Read up to `lines` whole lines, but not more than `size` bytes """
+    with open_source(filename, source) as f:
+        head = f.read(size)
+        complete = not f.read(1)
+    parts = head.split(b'\n', lines)
+    if len(parts) > lines:
+        head = head[:len(head) - len(parts[-1])]
+    elif not complete and len(parts) > 1:
+        # drop the cut line, it may end inside a multibyte character
+        head = head[:len(head) - len(parts[-1])]
+    elif not complete:
+        # the only line is cut: drop a multibyte character split at the end
+        try:
+            head.decode('utf8')
+        except UnicodeDecodeError as e:
+            if e.reason == 'unexpected end of data':
+                head = head[:e.start]
+    return head
+
+
+def sniff_file(filename, source=None):
+    """
+    Detect encoding, delimiter and quoting of a CSV file. Result is cached by path, size and mtime
+    (archive members by archive path, member name, size and mtime).
+    """
+    stat = os.stat(filename)
+    if source is None:
+        return _sniff_file(os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    return _sniff_file(os.path.abspath(filename), stat.st_size, stat.st_mtime, source.member, source.password)
+
+
+@lru_cache(maxsize=64)
+def _sniff_file(filename, size, mtime, member=None, password=None):
+    source = ArchiveMember(filename, member, password) if member else None
+    head = read_head(filename, source=source)
+    return detect_encoding(head), detect_delimiter(head), detect_quoting(head)
+
+
+def _count_stream_lines(f, size, estimate=False, sample_size=COUNT_SAMPLE_SIZE):
+    # archive members are counted over decompressed blocks
+    if estimate and size and size > sample_size:
+        sample = f.read(sample_size)
+        return max(int(sample.count(b'\n') * size / len(sample)), 1) if sample else 0
     lines = 0
-    readline = buf.readline
-    while readline():
+    last = b''
+    while True:
+        block = f.read(COUNT_BLOCK_SIZE)
+        if not block:
+            break
+        lines += block.count(b'\n')
+        last = block[-1:]
+    if last and last != b'\n':
         lines += 1
     return lines
 
 
+def count_lines(filename, estimate=False, sample_size=COUNT_SAMPLE_SIZE, source=None):
+    if source is not None:
+        with source.open() as f:
+            if estimate and source.size is None:
+                # gzip: extrapolate by the compressed bytes consumed for the sample
+                sample = f.read(sample_size)
+                consumed = f.fileobj.tell()
+                size = os.path.getsize(filename)
+                if len(sample) == sample_size and consumed < size:
+                    return max(int(sample.count(b'\n') * size / consumed), 1)
+                f.seek(0)
+            return _count_stream_lines(f, source.size, estimate, sample_size)
+    size = os.path.getsize(filename)
+    if not size:
+        return 0
+    with open(filename, 'rb') as f:
+        if estimate and size > sample_size:
+            # extrapolate the number of lines from the beginning of the file
+            sample = f.read(sample_size)
+            return max(int(sample.count(b'\n') * size / len(sample)), 1)
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            lines = 0
+            for offset in range(0, size, COUNT_BLOCK_SIZE):
+                lines += buf[offset:offset + COUNT_BLOCK_SIZE].count(b'\n')
+            # last line without line break
+            if buf[size - 1] != ord('\n'):
+                lines += 1
+        finally:
+            buf.close()
+    return lines
+
+
+def _to_decimal(value):
+    return Decimal(R_NOT_DECIMAL.sub('', value.replace(',', '.')))
+
+
+def _to_int(value):
+    value = _to_decimal(value)
+    if value != value.to_integral_value():
+        raise ValueError('%s is not integer' % value)
+    return int(value)
+
+
+def _to_date(value):
+    result = to_date(value)
+    if result is None:
+        raise ValueError('%s is not date' % value)
+    return result.date()
+
+
+def _to_phone(value):
+    result = clean_phone(value)
+    if not result:
+        raise ValueError('%s is not phone' % value)
+    return result
+
+
+COERCERS = {
+    'decimal': _to_decimal,
+    'int': _to_int,
+    'date': _to_date,
+    'phone': _to_phone,
+    'slug': get_slug,
+}
+
+
+def compile_struct(struct, required=()):
+    """
+    Compile struct ({'name': column number starting from 1}) and required names into a parse plan
+    with precomputed column indexes, so rows are mapped without per-cell lookups.
+    Typed columns are given as {'name': (column number, type)}, type is one of COERCERS.
+    """
+    items = []
+    types = []
+    for key, value in struct.items():
+        kind = None
+        if isinstance(value, (list, tuple)):
+            value, kind = value
+        if not value:
+            continue
+        if kind:
+            if kind not in COERCERS:
+                raise ValueError('Unknown type "%s" of field "%s"' % (kind, key))
+            types.append((key, kind))
+        items.append((key, int(value) - 1))
+    keys = tuple(key for key, column in items)
+    columns = tuple(column for key, column in items)
+    required = set(required)
+    getter = None
+    if columns:
+        # itemgetter with one index returns the value itself, a repeated index keeps the result a tuple
+        getter = operator.itemgetter(*(columns if len(columns) > 1 else columns * 2))
+    return Struct(keys=keys,
+                  columns=columns,
+                  items=tuple((key, column, key in required) for key, column in items),
+                  required=tuple(key for key in keys if key in required),
+                  required_keys=frozenset(required),
+                  types=tuple(types),
+                  cache={},
+                  blank=dict((k, '') for k in struct.keys()),
+                  unmapped=dict((k, '') for k in struct.keys() if k not in keys),
+                  getter=getter,
+                  size=max(columns) + 1 if columns else 0)
+
+
+def _coerce_column(values, kind, cache):
+    """ Convert column values to type, returns converted values and positions of wrong ones """
+    convert = COERCERS[kind]
+    result = []
+    wrong = []
+    for i, value in enumerate(values):
+        if not value:
+            result.append(None)
+            continue
+        try:
+            converted = cache[value]
+        except KeyError:
+            try:
+                converted = convert(value)
+            except (ValueError, ArithmeticError):
+                converted = WRONG_VALUE
+            if len(cache) >= COERCE_CACHE_SIZE:
+                cache.clear()
+            cache[value] = converted
+        if converted is WRONG_VALUE:
+            wrong.append(i)
+            converted = None
+        result.append(converted)
+    return result, wrong
+
+
+def _coerce_rows(items, plan):
+    """ Convert typed columns of a batch of parsed rows (values, problems, raw) """
+    for key, kind in plan.types:
+        values, wrong = _coerce_column([item[0][key] for item in items], kind, plan.cache.setdefault(key, {}))
+        for item, value in zip(items, values):
+            item[0][key] = value
+        for i in wrong:
+            values, problems, raw = items[i]
+            items[i] = (values, list(problems) + [(key, FIELD_WRONG)], raw)
+    return items
+
+
+def _parse_row(row, plan, encoding, debug=False):
+    # returns mapped values, problems as (key, FIELD_*) pairs and raw row for debug
+    problems = ()
+    if len(row) >= plan.size:
+        values = dict(zip(plan.keys, [
+            v.strip() if v.__class__ is str else force_str(v, encoding, errors='ignore').strip()
+            for v in plan.getter(row)] if plan.getter else ()))
+        if plan.required:
+            problems = [(key, FIELD_EMPTY) for key in plan.required if not values[key]]
+        if plan.unmapped:
+            values.update(plan.unmapped)
+    else:
+        values = dict(plan.blank)
+        problems = []
+        for key, column, required in plan.items:
+            try:
+                value = row[column]
+            except IndexError:
+                problems.append((key, FIELD_MISSING))
+                continue
+            if value.__class__ is not str:
+                value = force_str(value, encoding, errors='ignore')
+            value = values[key] = value.strip()
+            if not value and required:
+                problems.append((key, FIELD_EMPTY))
+    raw = ';'.join(map(force_str, row)) if debug else None
+    return values, problems, raw
+
+
+def _parse_csv_range(filename, begin, end, encoding, dialect, plan, debug):
+    with open(filename, 'rb') as f:
+        f.seek(begin)
+        data = f.read(end - begin)
+    text = io.StringIO(data.decode(encoding, errors='replace'), newline=None)
+    del data
+    result = []
+    stopped = False
+    try:
+        for row in csv.reader(text, **dialect):
+            result.append(_parse_row(row, plan, encoding, debug))
+    except CSVError as e:
+        if str(e) not in ('newline inside string', 'line contains NUL'):
+            raise e
+        stopped = True
+    if plan.types:
+        result = _coerce_rows(result, plan)
+    return result, stopped
+
+
+def _to_floats(values):
+    try:
+        result = [float(v) for v in values]
+    except ValueError:
+        result = []
+        for v in values:
+            try:
+                result.append(float(v.replace(',', '.').replace(' ', '')))
+            except (ValueError, AttributeError):
+                result.append(float('nan'))
+    if numpy is not None:
+        return numpy.array(result, dtype=float)
+    return result
+
+
 class ExcelReader(object):
+    """
+    Legacy .xls reader. Workbook globals are read first and sheets are loaded when iterated.
+    sheets - list of sheet indexes or names to read (all by default).
+    on_demand - unload each sheet when it is read, so only one sheet is kept in memory.
+    """
 
     def __init__(self, filename, **kwargs):
-        if not os.path.isfile(filename):
+        source = kwargs.get('source')
+        if source is None and not os.path.isfile(filename):
             raise NameError("%s is not a valid filename" % filename)
         self.filename = filename
+        # archive member is read into memory
+        self.contents = source.read() if source is not None else None
         self.book = None
+        self.sheet = None
         self.encoding = kwargs.get('encoding') or 'utf8'
+        self.on_demand = kwargs.get('on_demand', False)
+        self._start = self._position = [0, 0]
+        self._open()
+        names = self.book.sheet_names()
+        sheets = kwargs.get('sheets')
+        if sheets is None:
+            self.sheet_indexes = list(range(self.book.nsheets))
+        else:
+            self.sheet_indexes = [names.index(s) if isinstance(s, str) else int(s) for s in sheets]
+        # position in sheet_indexes of the sheet to start from
+        self._first = 0
+
+    def _open(self):
+        # only workbook globals are parsed here, so a wrong encoding costs little
         try:
-            self.book = xlrd.open_workbook(filename, encoding_override=self.encoding, ignore_workbook_corruption=True)
+            self.book = xlrd.open_workbook(self.filename, file_contents=self.contents,
+                                           encoding_override=self.encoding, on_demand=True,
+                                           ignore_workbook_corruption=True)
         except Exception:
-            self.book = xlrd.open_workbook(filename, encoding_override='cp1251', ignore_workbook_corruption=True)
-            self.sheet = self.book.sheet_by_index(0)
+            if self.encoding == 'cp1251':
+                raise
+            self.encoding = 'cp1251'
+            self._open()
+
+    def _load_sheet(self, index):
+        try:
+            return self.book.sheet_by_index(index)
+        except UnicodeDecodeError:
+            if self.encoding == 'cp1251':
+                raise
+            self.book.release_resources()
+            self.encoding = 'cp1251'
+            self._open()
+            return self.book.sheet_by_index(index)
+
+    def _unload_sheet(self, index):
+        if self.on_demand and self.book.sheet_loaded(index):
+            self.book.unload_sheet(index)
 
     def __formatrow__(self, types, values):
         #  Data Type Codes:
@@ -94,17 +439,14 @@ class ExcelReader(object):
         #  BOOLEAN 4 int; 1 means TRUE, 0 means FALSE
         #  ERROR 5
         returnrow = []
-        for i in range(len(types)):
-            type, value = types[i], values[i]
+        append = returnrow.append
+        for type, value in zip(types, values):
             if type == 2:
-                if value == int(value):
+                if value.is_integer():
                     value = int(value)
-            # elif type == 3:
-            #    datetuple = xlrd.xldate_as_tuple(value, self.book.datemode)
-            #    value = datetime.date(*datetuple[:3])
             elif type == 5:
                 value = xlrd.error_text_from_code[value]
-            returnrow.append(value)
+            append(value)
         return returnrow
 
     @cached_property
@@ -112,155 +454,426 @@ class ExcelReader(object):
         if not self.book:
             return 0
         total = 0
-        for sheet in self.book.sheets():
-            total += sheet.nrows
+        for index in self.sheet_indexes:
+            loaded = self.book.sheet_loaded(index)
+            total += self._load_sheet(index).nrows
+            if not loaded:
+                self._unload_sheet(index)
         return total
 
     def __iter__(self):
         if not self.book:
             return
-        for sheet in self.book.sheets():
-            self.sheet = sheet
-            for row in range(0, self.sheet.nrows):
+        first_row = self._start[1]
+        for number, index in enumerate(self.sheet_indexes):
+            if number < self._first:
+                continue
+            self.sheet = self._load_sheet(index)
+            for row in range(first_row if number == self._first else 0, self.sheet.nrows):
+                self._position = [index, row + 1]
                 types, values = self.sheet.row_types(row), self.sheet.row_values(row)
                 yield self.__formatrow__(types, values)
+            self.sheet = None
+            self._unload_sheet(index)
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position):
+        # position keeps the sheet index, sheets may be read in any order
+        if position[0] not in self.sheet_indexes:
+            raise Exception('Sheet %s is not read' % position[0])
+        self._first = self.sheet_indexes.index(position[0])
+        self._start = self._position = list(position)
 
     def row(self, num):
         if not self.book:
             return []
+        if self.sheet is None:
+            self.sheet = self._load_sheet(self.sheet_indexes[0])
         types, values = self.sheet.row_types(num), self.sheet.row_values(num)
         return self.__formatrow__(types, values)
 
 
+def _xlsx_text(node):
+    # text of <si> or <is> node: plain <t> and rich text runs, without phonetic hints
+    result = []
+    for child in node:
+        if child.tag == XLSX_TEXT:
+            result.append(child.text or '')
+        elif child.tag == XLSX_RUN:
+            result.append(child.findtext(XLSX_TEXT) or '')
+    return ''.join(result)
+
+
+def _xlsx_column(coordinate):
+    index = 0
+    for char in coordinate:
+        if char.isdigit():
+            break
+        index = index * 26 + ord(char) - 64
+    return index
+
+
+class CaseInsensitiveNames(list):
+
+    def __init__(self, names):
+        super(CaseInsensitiveNames, self).__init__(names)
+        self.lower = set(name.lower() for name in names)
+
+    def __contains__(self, name):
+        return name.lower() in self.lower
+
+
+class CaseInsensitiveZipFile(ZipFile):
+    """
+    Read-only ZipFile which finds members regardless of the name case,
+    e.g. "xl/sharedStrings.xml" stored as "xl/SharedStrings.xml" by some exporters.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CaseInsensitiveZipFile, self).__init__(*args, **kwargs)
+        self._lower_names = dict((info.filename.lower(), info) for info in self.infolist())
+
+    def getinfo(self, name):
+        info = self.NameToInfo.get(name) or self._lower_names.get(name.lower())
+        if info is None:
+            raise KeyError('There is no item named %r in the archive' % name)
+        return info
+
+    def has(self, name):
+        return name in self.NameToInfo or name.lower() in self._lower_names
+
+
+def load_workbook(filename):
+    """ openpyxl read-only workbook, members are looked up case-insensitively """
+    reader = OpenpyxlReader(filename, read_only=True, data_only=True)
+    reader.archive.close()
+    reader.archive = CaseInsensitiveZipFile(filename)
+    reader.valid_files = CaseInsensitiveNames(reader.archive.namelist())
+    reader.read()
+    return reader.wb
+
+
+class XLSXFile(object):
+    """
+    Lightweight streaming reader of xlsx worksheets: sheet XML is parsed with iterparse right from
+    the zip member, shared strings are read once into a list and rows are yielded as plain values.
+    Raises an exception for files it does not understand, so the caller can fall back to openpyxl.
+    """
+
+    def __init__(self, filename):
+        self.archive = CaseInsensitiveZipFile(filename)
+        try:
+            self._read_workbook()
+        except Exception:
+            self.archive.close()
+            raise
+
+    def _path(self, base, target):
+        if target.startswith('/'):
+            return target[1:]
+        return posixpath.normpath(posixpath.join(posixpath.dirname(base), target))
+
+    def _relations(self, part):
+        rels = posixpath.join(posixpath.dirname(part), '_rels', posixpath.basename(part) + '.rels')
+        if not self.archive.has(rels):
+            return {}
+        tree = ElementTree.fromstring(self.archive.read(rels))
+        return dict((rel.get('Id'), (rel.get('Type', '').rsplit('/', 1)[-1], self._path(part, rel.get('Target'))))
+                    for rel in tree.iter(XLSX_RELATIONSHIP))
+
+    def _read_workbook(self):
+        workbook = [path for kind, path in self._relations('').values() if kind == 'officeDocument'][0]
+        relations = self._relations(workbook)
+        tree = ElementTree.fromstring(self.archive.read(workbook))
+        properties = tree.find(XLSX_NS + 'workbookPr')
+        self.epoch = CALENDAR_WINDOWS_1900
+        if properties is not None and properties.get('date1904') in ('1', 'true'):
+            self.epoch = CALENDAR_MAC_1904
+        self.sheets = []
+        for sheet in tree.iter(XLSX_NS + 'sheet'):
+            kind, path = relations[sheet.get(XLSX_REL_ID)]
+            if kind == 'worksheet':
+                self.sheets.append(path)
+        if not self.sheets:
+            raise ValueError('No worksheets found')
+        self.shared_strings = []
+        self.date_styles = set()
+        self.timedelta_styles = set()
+        for kind, path in relations.values():
+            if kind == 'sharedStrings':
+                self._read_shared_strings(path)
+            elif kind == 'styles':
+                self._read_styles(path)
+
+    def _read_shared_strings(self, path):
+        strings = self.shared_strings
+        with self.archive.open(path) as f:
+            for event, node in ElementTree.iterparse(f):
+                if node.tag == XLSX_STRING:
+                    strings.append(_xlsx_text(node).replace('x005F_', ''))
+                    node.clear()
+
+    def _read_styles(self, path):
+        tree = ElementTree.fromstring(self.archive.read(path))
+        formats = dict(BUILTIN_FORMATS)
+        for node in tree.iter(XLSX_NS + 'numFmt'):
+            formats[int(node.get('numFmtId'))] = node.get('formatCode')
+        xfs = tree.find(XLSX_NS + 'cellXfs')
+        for index, node in enumerate(xfs if xfs is not None else []):
+            code = formats.get(int(node.get('numFmtId', 0)))
+            if code and is_date_format(code):
+                self.date_styles.add(index)
+                if is_timedelta_format(code):
+                    self.timedelta_styles.add(index)
+
+    def dimension(self, index):
+        """ Returns (rows, columns) from the sheet dimension or (None, None) """
+        with self.archive.open(self.sheets[index]) as f:
+            for event, node in ElementTree.iterparse(f, events=('start',)):
+                if node.tag == XLSX_NS + 'dimension':
+                    ref = node.get('ref', '').split(':')[-1]
+                    if ref and ref[-1].isdigit():
+                        return int(ref[len(ref.rstrip('0123456789')):]), _xlsx_column(ref)
+                    break
+                if node.tag == XLSX_NS + 'sheetData':
+                    break
+        return None, None
+
+    def _value(self, cell):
+        kind = cell.get('t')
+        if kind == 'inlineStr':
+            node = cell.find(XLSX_NS + 'is')
+            return _xlsx_text(node) if node is not None else None
+        value = cell.findtext(XLSX_VALUE) or None
+        if value is None:
+            return None
+        if kind is None or kind == 'n':
+            style = cell.get('s')
+            if style and int(style) in self.date_styles:
+                style = int(style)
+                try:
+                    return from_excel(float(value), self.epoch, timedelta=style in self.timedelta_styles)
+                except (OverflowError, ValueError):
+                    return '#VALUE!'
+            if '.' in value or 'E' in value or 'e' in value:
+                value = float(value)
+                if value.is_integer():
+                    return int(value)
+                return value
+            return int(value)
+        if kind == 's':
+            return self.shared_strings[int(value)]
+        if kind == 'b':
+            return bool(int(value))
+        if kind == 'd':
+            return from_ISO8601(value)
+        return value
+
+    def iter_rows(self, index, min_row=1):
+        """ Yields (row number, values) of the sheet, missing rows are filled when the width is known """
+        rows, width = self.dimension(index)
+        filler = [''] * width if width else None
+        row_number = 0
+        sheet_data = None
+        with self.archive.open(self.sheets[index]) as f:
+            for event, node in ElementTree.iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    if node.tag == XLSX_SHEET_DATA:
+                        sheet_data = node
+                    continue
+                if node.tag != XLSX_ROW:
+                    continue
+                number = node.get('r')
+                number = int(number) if number else row_number + 1
+                if filler is not None:
+                    for missing in range(max(row_number + 1, min_row), number):
+                        yield missing, filler[:]
+                row_number = number
+                if number >= min_row:
+                    result = []
+                    column = 0
+                    for cell in node:
+                        if cell.tag != XLSX_CELL:
+                            continue
+                        coordinate = cell.get('r')
+                        column = _xlsx_column(coordinate) if coordinate else column + 1
+                        if column > len(result) + 1:
+                            result.extend([''] * (column - len(result) - 1))
+                        value = self._value(cell)
+                        result.append('' if value is None else value)
+                    if width and len(result) < width:
+                        result.extend([''] * (width - len(result)))
+                    yield number, result
+                # drop parsed rows, so memory does not grow with the sheet
+                if sheet_data is not None:
+                    sheet_data.clear()
+
+    def close(self):
+        self.archive.close()
+
+
 class ExcelNewReader(object):
 
     def __init__(self, filename, **kwargs):
-        if not os.path.isfile(filename):
+        source = kwargs.get('source')
+        if source is None and not os.path.isfile(filename):
             raise NameError("%s is not a valid filename" % filename)
         self.filename = filename
+        self.book = None
+        self.xlsx = None
+        # archive member is read into memory, xlsx needs random access to its own zip members
+        target = io.BytesIO(source.read()) if source is not None else filename
         try:
-            self.book = load_workbook(filename, read_only=True, data_only=True)
-        except KeyError:  # try to fix: "There is no item named 'xl/sharedStrings.xml' in the archive"
-            self._patch_broken_file()
-            self.book = load_workbook(filename, read_only=True, data_only=True)
-        self.sheet = self.book.active
+            self.xlsx = XLSXFile(target)
+        except Exception:
+            # exotic files are read by openpyxl
+            self.book = load_workbook(target)
+            self.sheet = self.book.active
         self.encoding = 'utf8'
-
-    def _patch_broken_file(self):
-        from zipfile import ZipFile
-        tmpdir = os.path.join(tempfile.gettempdir(), 'patch_excel')
-
-        if os.path.exists(tmpdir):
-            shutil.rmtree(tmpdir)
-        os.makedirs(tmpdir)
-
-        with ZipFile(self.filename) as _file:
-            _file.extractall(tmpdir)
-        wrong_file_path = os.path.join(tmpdir, 'xl', 'SharedStrings.xml')
-        correct_file_path = os.path.join(tmpdir, 'xl', 'sharedStrings.xml')
-        os.rename(wrong_file_path, correct_file_path)
-        base_file_name = os.path.splitext(os.path.basename(self.filename))[0]
-        name = shutil.make_archive(os.path.join(tempfile.gettempdir(), base_file_name), 'zip', tmpdir)
-        shutil.rmtree(tmpdir)
-        os.remove(self.filename)
-        shutil.move(name, self.filename)
+        self._start = self._position = [0, 0]
 
     def _correct(self, value):
         if value is None:
             return ''
         # fix problem when read integer(float) numbers
-        if isinstance(value, float):
-            value = R_0.sub('', str(value))
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
         return value
 
     @cached_property
     def count(self):
+        total = 0
+        if self.xlsx:
+            for index in range(len(self.xlsx.sheets)):
+                total += self.xlsx.dimension(index)[0] or 0
+            return total
         if not self.book:
             return 0
-        total = 0
         for sheet in self.book.worksheets:
             if sheet.max_row:
                 total += sheet.max_row
         return total
 
     def __iter__(self):
+        if self.xlsx:
+            yield from self._iter_xlsx()
+            return
         if not self.book:
             return
-        for sheet in self.book.worksheets:
+        first_sheet, first_row = self._start
+        for index, sheet in enumerate(self.book.worksheets):
+            if index < first_sheet:
+                continue
             self.sheet = sheet
-            for row in self.sheet.iter_rows():
+            min_row = first_row + 1 if index == first_sheet else 1
+            for row_number, row in enumerate(self.sheet.iter_rows(min_row=min_row), start=min_row):
+                self._position = [index, row_number]
                 result = [self._correct(cell.value) for cell in row]
                 if result:
                     yield result
 
+    def _iter_xlsx(self):
+        first_sheet, first_row = self._start
+        for index in range(first_sheet, len(self.xlsx.sheets)):
+            min_row = first_row + 1 if index == first_sheet else 1
+            for row_number, result in self.xlsx.iter_rows(index, min_row):
+                self._position = [index, row_number]
+                if result:
+                    yield result
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position):
+        self._start = self._position = list(position)
+
     def row(self, num):
-        return [r.value for r in self.sheet.rows[num]]
+        for row in itertools.islice(self, num, num + 1):
+            return row
 
 
 class HTMLReader(object):
 
     def __init__(self, filename, **kwargs):
-        self.filename = filename
-        if not os.path.isfile(filename):
+        self.source = kwargs.get('source')
+        if self.source is None and not os.path.isfile(filename):
             raise NameError("%s is not a valid filename" % filename)
         self.filename = filename
         self.encoding = kwargs.get('encoding') or 'utf8'
-        self.data = []
-        self.__read()
-
-    def __read(self):
-        row = []
-        file = open(self.filename, 'r')
-        tr_begin = re.compile(r'\<tr.*?\>')
-        tr_end = re.compile(r'\</tr\>')
-        td = re.compile(r'\<td.*?\>(.+?)\</td\>')
-        for line in file:
-            res = tr_begin.search(line)
-            if res:
-                row = []
-            res = td.search(line)
-            if res:
-                row.append(res.group(1))
-            res = tr_end.search(line)
-            if res and row:
-                self.data.append(row)
+
+    def __iter__(self):
+        # tags may be split between chunks, so an unfinished tail is carried over to the next chunk
+        row = None
+        cell = None
+        tail = ''
+        with io.TextIOWrapper(open_source(self.filename, self.source), encoding=self.encoding,
+                              errors='replace') as f:
+            while True:
+                chunk = f.read(HTML_CHUNK_SIZE)
+                data = tail + chunk
+                limit = len(data)
+                if chunk:
+                    last = data.rfind('<')
+                    if last >= 0 and data.find('>', last) < 0:
+                        limit = last
+                pos = 0
+                for match in R_HTML_TAG.finditer(data, 0, limit):
+                    if cell is not None:
+                        cell.append(data[pos:match.start()])
+                    pos = match.end()
+                    closing, tag = match.group(1), match.group(2).lower()
+                    if cell is not None and (closing or tag == 'td'):
+                        row.append(''.join(cell))
+                        cell = None
+                    if tag == 'tr':
+                        if closing:
+                            if row:
+                                yield row
+                            row = None
+                        else:
+                            row = []
+                    elif not closing and row is not None:
+                        cell = []
+                if cell is not None:
+                    cell.append(data[pos:limit])
+                tail = data[limit:]
+                if not chunk:
+                    break
 
     @cached_property
     def count(self):
-        return len(self.data)
-
-    def __iter__(self):
-        for i in range(0, len(self.data)):
-            yield self.data[i]
+        total = 0
+        for row in self:
+            total += 1
+        return total
 
     def row(self, num):
-        return self.data[num]
+        for row in itertools.islice(self, num, num + 1):
+            return row
 
 
 class CSVReader(object):
 
     def __init__(self, filename, **kwargs):
         self.filename = filename
+        self.source = kwargs.get('source')
         self.data = []
-        with open(filename, 'rb') as f:
-            head = b"".join([line for x, line in enumerate(f) if x < 500])
-        self.encoding = detect_encoding(head)
-        delimiter = kwargs.get('delimiter') or detect_delimiter(head)
-        quoting = kwargs.get('quoting')
-        if quoting is None:
-            quoting = detect_quoting(head)
-        else:
-            quoting = int(quoting)
+        self.encoding, delimiter, quoting = sniff_file(filename, self.source)
+        delimiter = kwargs.get('delimiter') or delimiter
+        if kwargs.get('quoting') is not None:
+            quoting = int(kwargs['quoting'])
         if quoting == csv.QUOTE_NONE:
             quotechar = None
         else:
             quotechar = '"'
-        delimiter = force_str(delimiter)
-        f = open(filename, 'r', encoding=self.encoding, errors='replace')
-        self.csv_file = csv.reader(f,
-                                   quoting=quoting,
-                                   delimiter=delimiter,
-                                   quotechar=quotechar)
+        self.dialect = dict(quoting=quoting,
+                            delimiter=force_str(delimiter),
+                            quotechar=quotechar)
+        self.file = io.TextIOWrapper(open_source(filename, self.source), encoding=self.encoding, errors='replace')
+        # readline keeps file.tell() available during iteration
+        self.csv_file = csv.reader(iter(self.file.readline, ''), **self.dialect)
 
     def __iter__(self):
         try:
@@ -270,27 +883,201 @@ class CSVReader(object):
             if str(e) not in ('newline inside string', 'line contains NUL'):
                 raise e
 
+    def tell(self):
+        # for utf8, cp1251 and cp866 at a line break this is the byte offset (of decompressed data for archives)
+        return self.file.tell()
+
+    def seek(self, position):
+        self.file.seek(position)
+
+    def split(self, chunk_size=PARSE_CHUNK_SIZE, begin=0):
+        """
+        Split file into (begin, end) byte ranges of about chunk_size bytes.
+        Ranges end on a line break outside of quoted fields, so every range holds whole rows.
+        Not available for archive members.
+        """
+        size = os.path.getsize(self.filename)
+        quotechar = self.dialect['quotechar']
+        quotechar = quotechar.encode(self.encoding) if quotechar else None
+        ranges = []
+        with open(self.filename, 'rb') as f:
+            while begin < size:
+                f.seek(begin)
+                data = f.read(chunk_size)
+                line = f.readline()
+                end = begin + len(data) + len(line)
+                if quotechar:
+                    quotes = data.count(quotechar) + line.count(quotechar)
+                    while quotes % 2 and line:
+                        line = f.readline()
+                        quotes += line.count(quotechar)
+                        end += len(line)
+                ranges.append((begin, end))
+                begin = end
+        return ranges
+
     @cached_property
     def count(self):
-        return count_lines(self.filename)
+        return count_lines(self.filename, source=self.source)
+
+    @cached_property
+    def estimated_count(self):
+        return count_lines(self.filename, estimate=True, source=self.source)
 
     def row(self, num):
         # not implemented
         return
 
 
+def _dbf_character(data, field, encoding):
+    return data.decode(encoding, errors='replace').strip()
+
+
+def _dbf_numeric(data, field, encoding):
+    data = data.replace(b'\x00', b'').strip()
+    if not data or data[:1] == b'*':
+        return None
+    if field.decimals:
+        return float(data)
+    return int(data)
+
+
+def _dbf_date(data, field, encoding):
+    if data in (b'        ', b'00000000'):
+        return None
+    try:
+        return datetime.date(int(data[:4]), int(data[4:6]), int(data[6:8]))
+    except ValueError:
+        return None
+
+
+def _dbf_logical(data, field, encoding):
+    if data in b'tTyY':
+        return True
+    if data in b'fFnN':
+        return False
+    return None
+
+
+def _dbf_integer(data, field, encoding):
+    return unpack('<i', data)[0]
+
+
+def _dbf_double(data, field, encoding):
+    return unpack('<d', data)[0]
+
+
+def _dbf_currency(data, field, encoding):
+    return Decimal('%de-4' % unpack('<q', data)[0])
+
+
+DBF_CONVERTERS = {
+    'C': _dbf_character,
+    'N': _dbf_numeric,
+    'F': _dbf_numeric,
+    'D': _dbf_date,
+    'L': _dbf_logical,
+    'I': _dbf_integer,
+    'B': _dbf_double,
+    'Y': _dbf_currency,
+}
+
+
 class DBFReader(object):
+    """
+    Reads fixed-width records right from an mmap of the file using the field offsets from the header.
+    Only requested columns are decoded (see iter_columns); tables with field types not supported here
+    (memo and others) are read with the dbf library.
+    """
 
     def __init__(self, filename, **kwargs):
-        with open(filename, 'rb') as f:
+        self.source = kwargs.get('source')
+        # archive member is read into memory and used instead of the mmap
+        self.contents = self.source.read() if self.source is not None else None
+        self.filename = filename
+        with self._open() as f:
             head = f.read(2048)
         self.encoding = kwargs.get('encoding') or detect_encoding(head, force_cp1251=True)
-        self.table = dbf.Table(filename, codepage=self.encoding)
-        self.table.use_deleted = False
-        self.table.open()
+        self._start = self._position = 0
+        self._read_header()
+
+    def _open(self):
+        if self.source is not None:
+            return io.BytesIO(self.contents)
+        return open(self.filename, 'rb')
+
+    def _read_header(self):
+        with self._open() as f:
+            header = f.read(32)
+            self.records, self.header_size, self.record_size = unpack('<IHH', header[4:12])
+            self.fields = []
+            offset = 1  # deletion flag
+            while True:
+                data = f.read(32)
+                if not data or data[:1] == b'\r' or len(data) < 32:
+                    break
+                kind, length, decimals = chr(data[11]), data[16], data[17]
+                if kind != '0':  # visual foxpro _NullFlags system field
+                    self.fields.append(Struct(name=force_str(data[:11].split(b'\0')[0], 'ascii', errors='ignore'),
+                                              kind=kind, start=offset, end=offset + length, decimals=decimals))
+                offset += length
+
+    @cached_property
+    def table(self):
+        if self.source is not None:
+            raise Exception('DBF file with memo or unknown fields should be extracted from archive %s' % self.filename)
+        table = dbf.Table(self.filename, codepage=self.encoding)
+        table.use_deleted = False
+        table.open()
+        return table
 
     def __iter__(self):
-        for row in self.table:
+        return self.iter_columns()
+
+    def iter_columns(self, columns=None):
+        """ Yields rows, when columns (set of indexes) is given the other values are left empty """
+        if columns is None:
+            columns = range(len(self.fields))
+        fields = [(index, self.fields[index]) for index in sorted(columns) if index < len(self.fields)]
+        if any(field.kind not in DBF_CONVERTERS for index, field in fields):
+            yield from self._iter_table()
+            return
+        fields = [(index, field.start, field.end, DBF_CONVERTERS[field.kind], field) for index, field in fields]
+        blank = [''] * len(self.fields)
+        size = self.record_size
+        if self.source is not None:
+            yield from self._iter_records(self.contents, fields, blank)
+            return
+        with open(self.filename, 'rb') as f:
+            if not self.records or os.fstat(f.fileno()).st_size < self.header_size + size:
+                return
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield from self._iter_records(buf, fields, blank)
+            finally:
+                buf.close()
+
+    def _iter_records(self, buf, fields, blank):
+        encoding = self.encoding
+        size = self.record_size
+        # the last record may be cut in broken files
+        records = min(self.records, max(len(buf) - self.header_size, 0) // size)
+        for number in range(self._start, records):
+            offset = self.header_size + number * size
+            self._position = number + 1
+            if buf[offset] == 0x2A:  # deleted
+                continue
+            row = blank[:]
+            for index, start, end, convert, field in fields:
+                row[index] = convert(buf[offset + start:offset + end], field, encoding)
+            yield row
+
+    def _iter_table(self):
+        for number in range(self._start, len(self.table)):
+            row = self.table[number]
+            self._position = number + 1
+            if dbf.is_deleted(row):
+                continue
             result = []
             for r in row:
                 if isinstance(r, str):
@@ -301,23 +1088,41 @@ class DBFReader(object):
 
     @cached_property
     def count(self):
-        if not self.table:
-            return 0
-        return len(self.table)
+        return self.records
+
+    @property
+    def estimated_count(self):
+        # the header keeps the number of records
+        return self.records
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position):
+        self._start = self._position = position
 
 
 class Reader(object):
 
     def __init__(self, filename, **kwargs):
+        """
+        zip, gz and tar archives (e.g. price.csv.gz) are read without extracting:
+        member - file name in the archive (the first file by default), password - archive password.
+        """
         ext = os.path.splitext(filename)[1].lower()
         self.reader = None
         self.errors = ''
+        self.checkpoint = None
+        self._position = None
         if not os.path.exists(filename):
             raise Exception('File "%s" does not exists.' % filename)
+        if kwargs.get('member') is not None or archive_type(filename):
+            kwargs['source'] = ArchiveMember(filename, kwargs.get('member'), kwargs.get('password', ''))
+            ext = os.path.splitext(kwargs['source'].name)[1].lower()
         if ext == '.xls':
             self.reader = ExcelReader(filename, **kwargs)
         elif ext == '.xlsx':
-            self.reader = ExcelNewReader(filename)
+            self.reader = ExcelNewReader(filename, **kwargs)
         elif ext in ('.txt', '.csv', ''):
             self.reader = CSVReader(filename, **kwargs)
         elif ext == '.dbf':
@@ -331,40 +1136,212 @@ class Reader(object):
         return self.reader.__iter__()
 
     def parse(self, **kwargs):
+        """
+        Map rows to Struct objects by struct: {'name': column number (starting from 1)}.
+        workers > 1 parses CSV/TXT files in a pool of processes, rows are yielded in the file order.
+        checkpoint_every = N stores Struct(index=row number, position=reader position) in self.checkpoint
+        after every N rows handled by the caller; parse(resume_from=checkpoint) continues after that row.
+        """
         start = kwargs.get('start') or 0
         end = kwargs.get('end') or 0
         struct = kwargs.get('struct')
         required = kwargs.get('required', [])
         debug = kwargs.get('debug')
-        blank = Struct(**dict((k, '') for k in struct.keys()))
+        workers = kwargs.get('workers') or 0
+        checkpoint_every = kwargs.get('checkpoint_every') or 0
+        resume_from = kwargs.get('resume_from')
+        plan = compile_struct(struct, required)
         self.errors = []
-        for index, row in enumerate(self.reader, start=1):
-            ready = True
-            result = copy.copy(blank)
+        self.checkpoint = resume_from
+        if workers > 1 and isinstance(self.reader, CSVReader) and self.reader.source is None:
+            # typed columns are converted by the workers
+            rows = self._parse_parallel(plan, debug, workers, resume_from)
+            tell = self._batch_end
+        else:
+            rows = self._parse_serial(plan, debug, start, end, resume_from)
+            tell = getattr(self.reader, 'tell', None)
+            if plan.types:
+                rows = self._coerce_serial(rows, plan, tell)
+                tell = self._batch_end
+        messages = {
+            FIELD_MISSING: _('Row %(index)s: check field "%(key)s".'),
+            FIELD_EMPTY: _('Row %(index)s: empty field "%(key)s".'),
+            FIELD_WRONG: _('Row %(index)s: wrong value of field "%(key)s".'),
+        }
+        last = resume_from['index'] if resume_from else 0
+        for index, (values, problems, raw) in rows:
             if start > index:
                 continue
             if end and end < index:
                 break
-            for key, value in struct.items():
-                if not value:
-                    continue
-                try:
-                    result[key] = force_str(row[int(value) - 1], self.reader.encoding, errors='ignore').strip()
-                    if not result[key] and key in required:
-                        ready = False
-                        if len(self.errors) < MAX_ERRORS:
-                            self.errors.append(
-                                _('Row %(index)s: empty field "%(key)s".') % {'index': index, 'key': key})
-                        continue
-                except IndexError:
-                    if len(self.errors) < MAX_ERRORS:
-                        self.errors.append(
-                            _('Row %(index)s: check field "%(key)s".') % {'index': index, 'key': key})
+            ready = True
+            result = Struct(**values)
+            for key, problem in problems:
+                if problem != FIELD_MISSING and key in plan.required_keys:
+                    ready = False
+                self._add_error(messages[problem], index, key)
             if debug:
-                result._row = ';'.join(map(force_str, row))
+                result._row = raw
                 result._row_number = index
             if ready:
                 yield result
+            if checkpoint_every and tell and index - last >= checkpoint_every:
+                position = tell()
+                if position is not None:
+                    self.checkpoint = Struct(index=index, position=position)
+                    last = index
+
+    def _parse_serial(self, plan, debug, start, end, resume_from=None):
+        encoding = self.reader.encoding
+        first = 1
+        if resume_from:
+            first = resume_from['index'] + 1
+            if hasattr(self.reader, 'seek'):
+                self.reader.seek(resume_from['position'])
+        rows = self._rows(plan)
+        if resume_from and not hasattr(self.reader, 'seek'):
+            rows = itertools.islice(rows, resume_from['index'], None)
+        for index, row in enumerate(rows, start=first):
+            if start > index:
+                continue
+            if end and end < index:
+                break
+            yield index, _parse_row(row, plan, encoding, debug)
+
+    def _rows(self, plan):
+        # readers which can skip columns get only the mapped ones
+        if hasattr(self.reader, 'iter_columns'):
+            return self.reader.iter_columns(set(plan.columns))
+        return iter(self.reader)
+
+    def _coerce_serial(self, rows, plan, tell=None):
+        # rows are converted in batches, a checkpoint is possible only after the last row of a batch
+        while True:
+            batch = list(itertools.islice(rows, COERCE_BATCH_SIZE))
+            if not batch:
+                break
+            position = tell() if tell else None
+            items = _coerce_rows([item for index, item in batch], plan)
+            self._position = None
+            for number, ((index, item), converted) in enumerate(zip(batch, items), start=1):
+                if number == len(batch):
+                    self._position = position
+                yield index, converted
+
+    def _batch_end(self):
+        return self._position
+
+    def _parse_parallel(self, plan, debug, workers, resume_from=None):
+        reader = self.reader
+        index = 0
+        begin = 0
+        if resume_from:
+            index, begin = resume_from['index'], resume_from['position']
+        pending = deque()
+        ranges = iter(reader.split(PARSE_CHUNK_SIZE, begin))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            try:
+                while True:
+                    # keep a bounded number of chunks in flight
+                    for begin, end in itertools.islice(ranges, workers * 2 - len(pending)):
+                        pending.append((executor.submit(
+                            _parse_csv_range, reader.filename, begin, end, reader.encoding, reader.dialect,
+                            plan, debug), end))
+                    if not pending:
+                        break
+                    future, end = pending.popleft()
+                    result, stopped = future.result()
+                    # only the end of a chunk can be used as checkpoint position
+                    self._position = None
+                    for number, item in enumerate(result, start=1):
+                        index += 1
+                        if number == len(result):
+                            self._position = end
+                        yield index, item
+                    if stopped:
+                        break
+            finally:
+                for future, end in pending:
+                    future.cancel()
+
+    def parse_batches(self, **kwargs):
+        """
+        Column oriented variant of parse: yields {'name': [values]} dicts of up to batch_size rows.
+        Columns listed in numeric are converted to float NumPy arrays (lists without NumPy),
+        empty or wrong values become nan. Typed columns of struct are converted as in parse.
+        """
+        start = kwargs.get('start') or 0
+        end = kwargs.get('end') or 0
+        struct = kwargs.get('struct')
+        required = kwargs.get('required', [])
+        numeric = kwargs.get('numeric', [])
+        debug = kwargs.get('debug')
+        batch_size = kwargs.get('batch_size') or 50000
+        plan = compile_struct(struct, required)
+        self.errors = []
+        rows = []
+        first = None
+        for index, row in enumerate(self._rows(plan), start=1):
+            if start > index:
+                continue
+            if end and end < index:
+                break
+            if first is None:
+                first = index
+            rows.append(row)
+            if len(rows) >= batch_size:
+                yield self._make_batch(rows, first, struct, plan, numeric, debug)
+                rows = []
+                first = None
+        if rows:
+            yield self._make_batch(rows, first, struct, plan, numeric, debug)
+
+    def _add_error(self, message, index, key):
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append(message % {'index': index, 'key': key})
+
+    def _make_batch(self, rows, first, struct, plan, numeric, debug):
+        encoding = self.reader.encoding
+        size = len(rows)
+        types = dict(plan.types)
+        batch = dict((key, [''] * size) for key in struct.keys())
+        skip = set()
+        for key, column, required in plan.items:
+            missing = set()
+            try:
+                values = [row[column] for row in rows]
+            except IndexError:
+                values = []
+                for i, row in enumerate(rows):
+                    if column < len(row):
+                        values.append(row[column])
+                    else:
+                        values.append('')
+                        missing.add(i)
+                        self._add_error(_('Row %(index)s: check field "%(key)s".'), first + i, key)
+            values = [v.strip() if v.__class__ is str else force_str(v, encoding, errors='ignore').strip()
+                      for v in values]
+            if required and not all(values):
+                for i, value in enumerate(values):
+                    if not value and i not in missing:
+                        skip.add(i)
+                        self._add_error(_('Row %(index)s: empty field "%(key)s".'), first + i, key)
+            if key in types:
+                values, wrong = _coerce_column(values, types[key], plan.cache.setdefault(key, {}))
+                for i in wrong:
+                    if required:
+                        skip.add(i)
+                    self._add_error(_('Row %(index)s: wrong value of field "%(key)s".'), first + i, key)
+            batch[key] = values
+        if debug:
+            batch['_row_number'] = list(range(first, first + size))
+        if skip:
+            keep = [i not in skip for i in range(size)]
+            for key, values in batch.items():
+                batch[key] = list(itertools.compress(values, keep))
+        for key in numeric:
+            batch[key] = _to_floats(batch[key])
+        return batch
 
     def row(self, num):
         if not self.reader:
@@ -377,6 +1354,13 @@ class Reader(object):
             return
         return self.reader.count
 
+    @property
+    def estimated_count(self):
+        if not self.reader:
+            return
+        # None for readers which can not estimate without reading the whole file (html, xls)
+        return getattr(self.reader, 'estimated_count', None)
+
     def get_encoding(self):
         if not self.reader:
             return
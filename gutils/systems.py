@@ -105,6 +105,8 @@ def smart_download(url, **kwargs):
             url = location
             result.ext = force_extension or os.path.splitext(re.sub(r'\?.+', '', url))[1]
             response = client.get(url, timeout=timeout, headers=headers)
+        if response.status_code >= 400:
+            result.error = 'HTTP error %s: %s' % (response.status_code, url)
         # detect extension
         if not url.startswith('ftp://') and detect_extension and not force_extension:
             result.content_type = response.headers.get('Content-Type', '')